@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'xsukax-Word-Document-Comparator.py')
+
+
+@pytest.fixture(scope='session')
+def comparator():
+    """The comparator script loaded as a module"""
+    spec = importlib.util.spec_from_file_location('xsukax_comparator', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.mark.parametrize('occurrences, seeded', [(64, True), (65, False)])
+def test_histogram_seed_chain_limit(comparator, monkeypatch, occurrences, seeded):
+    fallbacks = []
+    myers_blocks = comparator._myers_blocks
+    
+    def record_fallback(*args):
+        fallbacks.append(args[1:3])
+        return myers_blocks(*args)
+    
+    monkeypatch.setattr(comparator, '_myers_blocks', record_fallback)
+    seq_a = ['x'] * occurrences
+    opcodes = comparator.histogram_opcodes(seq_a, ['x'])
+    
+    assert (fallbacks == []) is seeded
+    assert [tag for tag, *_ in opcodes].count('equal') == 1
@@ -0,0 +1,27 @@
+import io
+import threading
+
+
+def test_cancelled_queued_job_runs_its_cleanup(comparator):
+    queue = comparator.JobQueue(workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    
+    def block(job):
+        started.set()
+        release.wait(5)
+    
+    running = queue.submit(block)
+    started.wait(5)
+    
+    stream = io.BytesIO(b'upload')
+    queued = queue.submit(lambda job: None, cleanup=stream.close)
+    assert queue.cancel(queued.id).status == 'cancelled'
+    assert stream.closed
+    
+    finished_stream = io.BytesIO(b'upload')
+    finished = queue.submit(lambda job: 'ok', cleanup=finished_stream.close)
+    release.set()
+    finished.future.result(5)
+    assert running.status == 'done'
+    assert finished.status == 'done' and finished_stream.closed
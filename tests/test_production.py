@@ -0,0 +1,44 @@
+def test_pooled_call_reports_only_its_own_counters(comparator):
+    comparator.metrics.take_counters()
+    for _ in range(5):
+        comparator.metrics.inc('xsukax_requests_total', endpoint='/', method='GET', status=200)
+    
+    pool = comparator.ComparisonPool(workers=1)
+    try:
+        tokens = [comparator.tokenize_text('one two three')[0]]
+        pool.call(comparator.align_pair, tokens, [comparator.tokenize_text('one four three')[0]])
+    finally:
+        pool.shutdown()
+    
+    counters = dict(comparator.metrics.take_counters())
+    assert counters[('xsukax_requests_total', (('endpoint', '/'), ('method', 'GET'), ('status', 200)))] == 5
+    assert counters[('xsukax_comparisons_total', ())] == 1
+
+
+def test_session_revisions_stay_in_process(comparator, monkeypatch):
+    pool = comparator.ComparisonPool(workers=1)
+    monkeypatch.setattr(comparator, 'comparison_pool', pool)
+    try:
+        doc1 = [comparator.tokenize_text(line)[0] for line in ('one two', 'three four', 'five six')]
+        entry = {'session': comparator.ComparisonSession(doc1), 'doc1_name': 'a.docx',
+                 'lock': comparator.threading.Lock()}
+        comparator.run_session_comparison('s', entry, doc1, 'b.docx')
+        session = entry['session']
+        
+        revised = [comparator.tokenize_text(line)[0] for line in ('one two', 'three seven', 'five six')]
+        payload = comparator.run_session_comparison('s', entry, revised, 'b.docx')
+    finally:
+        pool.shutdown()
+    
+    assert entry['session'] is session
+    assert payload['revision'] == 2
+    assert payload['line_differences']['modified'] == [2]
+
+
+def test_create_app_leaves_module_namespace_alone(comparator):
+    app = comparator.create_app()
+    for name in ('Flask', 'Response', 'request', 'render_template_string', 'jsonify', 'stream_with_context'):
+        assert not hasattr(comparator, name)
+    
+    response = app.test_client().get('/')
+    assert response.status_code == 200
@@ -0,0 +1,60 @@
+import io
+import zipfile
+
+W_XMLNS = ('xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+           'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006"')
+
+
+def _paragraph(text):
+    return f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>'
+
+
+def _textbox(text):
+    content = f'<w:txbxContent>{_paragraph(text)}</w:txbxContent>'
+    return ('<w:p><w:r><mc:AlternateContent>'
+            f'<mc:Choice><w:drawing>{content}</w:drawing></mc:Choice>'
+            f'<mc:Fallback><w:pict>{content}</w:pict></mc:Fallback>'
+            '</mc:AlternateContent></w:r></w:p>')
+
+
+def _docx(paragraphs, rows=(), textboxes=()):
+    table = ''
+    if rows:
+        table = '<w:tbl>' + ''.join(f'<w:tr><w:tc>{_paragraph(row)}</w:tc></w:tr>' for row in rows) + '</w:tbl>'
+    body = ''.join(map(_paragraph, paragraphs)) + ''.join(map(_textbox, textboxes)) + table
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        archive.writestr('word/document.xml', f'<w:document {W_XMLNS}><w:body>{body}</w:body></w:document>')
+    stream.seek(0)
+    return stream
+
+
+def _section(sections, name):
+    return next(entry for entry in sections if entry['name'] == name)
+
+
+def test_textbox_extracted_once(comparator):
+    sections = dict(comparator.extract_docx_sections(_docx(['Body'], textboxes=['Box text'])))
+    assert sections['textboxes'] == [{'type': 'textbox', 'text': 'Box text', 'index': 1}]
+    assert sections['body'] == [{'type': 'paragraph', 'text': 'Body', 'index': 1}]
+
+
+def test_changed_paragraphs_keep_their_index(comparator):
+    doc1 = comparator.extract_docx_sections(_docx(['First one.', 'Second one.', 'Third one.', 'Fourth one.']))
+    doc2 = comparator.extract_docx_sections(_docx(['First one.', 'Second two.', 'Third one.', 'Fourth two.']))
+    _, sections = comparator.compare_sections(doc1, doc2)
+    assert _section(sections, 'body')['changed_blocks'] == [
+        {'type': 'paragraph', 'index': 2, 'document': 1},
+        {'type': 'paragraph', 'index': 4, 'document': 1},
+        {'type': 'paragraph', 'index': 2, 'document': 2},
+        {'type': 'paragraph', 'index': 4, 'document': 2},
+    ]
+
+
+def test_deleted_table_row_is_reported_from_document_1(comparator):
+    doc1 = comparator.extract_docx_sections(_docx(['Body'], rows=['row one', 'row two', 'row three']))
+    doc2 = comparator.extract_docx_sections(_docx(['Body'], rows=['row one', 'row three']))
+    _, sections = comparator.compare_sections(doc1, doc2)
+    assert _section(sections, 'table-1')['changed_blocks'] == [
+        {'type': 'table_cell', 'row': 2, 'col': 1, 'document': 1},
+    ]
@@ -5,17 +5,57 @@ A single-file web application for side-by-side Word document comparison.
 """
 
 import os
+import argparse
+import cProfile
 import io
+import math
+import platform
+import random
 import re
+import json
+import shutil
+import signal
+import tempfile
+import time
+import sqlite3
+import hashlib
+import threading
+import zipfile
+import uuid
+import tracemalloc
+from array import array
+from collections import Counter, OrderedDict
+from itertools import accumulate, groupby, islice, zip_longest
+from operator import or_
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import closing
 from datetime import datetime
-from flask import Flask, request, render_template_string, jsonify
-from docx import Document
-import docx2txt
-import pythoncom
-from difflib import SequenceMatcher
+from xml.etree import ElementTree
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher, unified_diff
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get('XSUKAX_MAX_UPLOAD_MB', 16)) * 1024 * 1024)
+MAX_DOCUMENT_WORDS = int(os.environ.get('XSUKAX_MAX_WORDS', 0))
+MAX_CPU_SECONDS = float(os.environ.get('XSUKAX_MAX_CPU_SECONDS', 0))
+SPOOL_MEMORY_BYTES = int(float(os.environ.get('XSUKAX_SPOOL_MEMORY_KB', 512)) * 1024)
+SPOOL_DIR = os.environ.get('XSUKAX_SPOOL_DIR') or None
+
+class LimitExceeded(Exception):
+    """Raised when a request goes over a configured size or CPU-time limit"""
+
+_routes = []
+
+def route(rule, **options):
+    """Register a view function with the Flask app built by create_app"""
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -38,6 +78,8 @@ HTML_TEMPLATE = """
         .upload-box h3 { margin-bottom: 15px; color: #24292e; font-size: 16px; font-weight: 600; }
         .file-input { width: 100%; margin: 15px 0; padding: 8px; border: 1px solid #d1d5da; border-radius: 6px; font-size: 14px; }
         .file-name { margin-top: 10px; color: #586069; font-size: 13px; min-height: 20px; }
+        .format-toggle { margin-right: 10px; font-size: 14px; color: #24292e; vertical-align: middle; cursor: pointer; }
+        .backend-select { padding: 11px 10px; margin-right: 10px; border: 1px solid #d1d5da; border-radius: 6px; font-size: 14px; background: white; color: #24292e; vertical-align: middle; }
         .btn { background: #2ea44f; color: white; border: none; padding: 12px 28px; border-radius: 6px; cursor: pointer; font-size: 14px; font-weight: 600; transition: background 0.2s ease; }
         .btn:hover { background: #2c974b; }
         .btn:disabled { background: #94d3a2; cursor: not-allowed; }
@@ -51,6 +93,7 @@ HTML_TEMPLATE = """
         .analytics-card.removed .value { color: #cb2431; }
         .analytics-card.modified .value { color: #b08800; }
         .analytics-card.similarity .value { color: #0366d6; }
+        .analytics-card.formatted .value { color: #6f42c1; }
         .differences-summary { background: white; padding: 20px; border-radius: 6px; margin-bottom: 20px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); display: none; }
         .differences-summary h3 { color: #24292e; font-size: 16px; font-weight: 600; margin-bottom: 15px; display: flex; align-items: center; gap: 8px; }
         .differences-summary h3::before { content: '📍'; }
@@ -60,12 +103,20 @@ HTML_TEMPLATE = """
         .diff-lines-section.added h4 { color: #22863a; }
         .diff-lines-section.removed h4 { color: #cb2431; }
         .diff-lines-section.modified h4 { color: #b08800; }
+        .diff-lines-section.formatted h4 { color: #6f42c1; }
         .line-numbers { display: flex; flex-wrap: wrap; gap: 6px; }
         .line-number-badge { background: white; color: #586069; padding: 4px 10px; border-radius: 4px; font-size: 12px; font-weight: 600; border: 1px solid #e1e4e8; font-family: 'Courier New', monospace; }
         .diff-lines-section.added .line-number-badge { border-color: #85e89d; color: #22863a; }
         .diff-lines-section.removed .line-number-badge { border-color: #fdaeb7; color: #cb2431; }
         .diff-lines-section.modified .line-number-badge { border-color: #ffd33d; color: #b08800; }
+        .diff-lines-section.formatted .line-number-badge { border-color: #d1bcf9; color: #6f42c1; }
         .no-differences { color: #586069; font-size: 13px; font-style: italic; }
+        .line-number-badge[data-line] { cursor: pointer; }
+        .refine-panel { display: none; margin-top: 20px; }
+        .refine-panel h4 { font-size: 13px; font-weight: 600; margin-bottom: 10px; color: #b08800; }
+        .refine-hunk { display: grid; grid-template-columns: 1fr 1fr; gap: 10px; margin-bottom: 10px; }
+        .refine-side { background: white; padding: 10px; border: 1px solid #e1e4e8; border-radius: 4px; font-family: 'Courier New', 'Courier', 'Noto Sans Arabic', monospace; font-size: 13px; white-space: pre-wrap; line-height: 1.8; }
+        .refine-side .char { border: none; border-radius: 2px; }
         .comparison-header { display: grid; grid-template-columns: 1fr 1fr; background: #f6f8fa; border-bottom: 1px solid #e1e4e8; padding: 12px 20px; }
         .document-title { font-weight: 600; color: #24292e; font-size: 14px; display: flex; align-items: center; }
         .document-title::before { content: '📄'; margin-right: 8px; }
@@ -89,6 +140,7 @@ HTML_TEMPLATE = """
         .different { background-color: #fff2c5; border: 1px solid #ffd33d; }
         .missing { background-color: #ffdce0; border: 1px solid #fdaeb7; color: #cb2431; text-decoration: line-through; }
         .added { background-color: #dcffe4; border: 1px solid #85e89d; color: #22863a; }
+        .formatted { background-color: #f5f0ff; border: 1px solid #d1bcf9; }
         .legend { display: flex; justify-content: center; gap: 20px; margin: 20px 0; flex-wrap: wrap; padding: 15px; background: white; border-radius: 6px; }
         .legend-item { display: flex; align-items: center; gap: 8px; font-size: 13px; color: #586069; }
         .color-box { width: 18px; height: 18px; border-radius: 3px; border: 1px solid; }
@@ -126,6 +178,16 @@ HTML_TEMPLATE = """
             </div>
             
             <div style="text-align: center;">
+                <select name="backend" class="backend-select" id="backendSelect" title="Diff algorithm">
+                    <option value="difflib">difflib</option>
+                    <option value="myers">Myers</option>
+                    <option value="histogram">Histogram</option>
+                    <option value="patience">Patience</option>
+                </select>
+                <label class="format-toggle" title="Also report bold, italic, font and style changes"><input type="checkbox" name="formatting" value="1"> Formatting</label>
+                <label class="format-toggle" title="Treat upper and lower case as equal"><input type="checkbox" name="normalize" value="case"> Ignore case</label>
+                <label class="format-toggle" title="Ignore spacing differences between words"><input type="checkbox" name="normalize" value="whitespace"> Ignore spacing</label>
+                <label class="format-toggle" title="Ignore Arabic diacritics and tatweel"><input type="checkbox" name="normalize" value="diacritics"> Ignore diacritics</label>
                 <button type="submit" class="btn" id="compareBtn">🔍 Compare Documents</button>
             </div>
         </form>
@@ -140,11 +202,13 @@ HTML_TEMPLATE = """
             <div class="legend-item"><div class="color-box different" style="background-color: #fff2c5; border-color: #ffd33d;"></div> Modified</div>
             <div class="legend-item"><div class="color-box missing" style="background-color: #ffdce0; border-color: #fdaeb7;"></div> Removed</div>
             <div class="legend-item"><div class="color-box added" style="background-color: #dcffe4; border-color: #85e89d;"></div> Added</div>
+            <div class="legend-item"><div class="color-box formatted" style="background-color: #f5f0ff; border-color: #d1bcf9;"></div> Formatting</div>
         </div>
 
         <div class="differences-summary" id="differencesSummary">
             <h3>Lines with Differences</h3>
             <div class="diff-lines-container" id="diffLinesContainer"></div>
+            <div class="refine-panel" id="refinePanel"></div>
         </div>
 
         <div class="comparison-section" id="comparisonSection">
@@ -180,10 +244,23 @@ HTML_TEMPLATE = """
             });
         });
 
+        let lastComparison = null;
+        let currentEtag = null;
+        
+        function comparisonRequestKey(form) {
+            const files = Array.from(form.querySelectorAll('input[type="file"]')).map(input => {
+                const file = input.files[0];
+                return file ? `${file.name}:${file.size}:${file.lastModified}` : '';
+            });
+            const normalize = Array.from(form.querySelectorAll('input[name="normalize"]:checked')).map(input => input.value);
+            return files.concat(form.elements.backend.value, form.elements.formatting.checked, normalize.join(',')).join('|');
+        }
+
         document.getElementById('uploadForm').addEventListener('submit', async function(e) {
             e.preventDefault();
             
             const formData = new FormData(this);
+            formData.append('mode', 'job');
             const compareBtn = document.getElementById('compareBtn');
             const loading = document.getElementById('loading');
             
@@ -192,13 +269,29 @@ HTML_TEMPLATE = """
             document.getElementById('comparisonSection').style.display = 'none';
             document.getElementById('legend').style.display = 'none';
             
+            const requestKey = comparisonRequestKey(this);
+            const headers = {};
+            if (lastComparison && lastComparison.requestKey === requestKey) {
+                headers['If-None-Match'] = lastComparison.etag;
+            }
+            
             try {
-                const response = await fetch('/compare', {
+                const response = await fetch('/api/compare', {
                     method: 'POST',
+                    headers: headers,
                     body: formData
                 });
                 
-                const result = await response.json();
+                let result;
+                if (response.status === 304) {
+                    result = lastComparison.result;
+                } else {
+                    result = await response.json();
+                    if (result.success && result.job_id) {
+                        result = await waitForJob(result.status_url);
+                    }
+                    lastComparison = result.success ? { requestKey, etag: `"${result.etag}"`, result } : null;
+                }
                 
                 if (result.success) {
                     displayComparison(result);
@@ -213,28 +306,54 @@ HTML_TEMPLATE = """
             }
         });
 
+        async function waitForJob(statusUrl) {
+            const loadingText = document.querySelector('#loading p');
+            try {
+                while (true) {
+                    const job = await (await fetch(statusUrl)).json();
+                    if (job.status === 'done') return job.result;
+                    if (!job.success || job.status === 'cancelled') {
+                        return { success: false, error: job.error || 'The comparison was cancelled' };
+                    }
+                    loadingText.textContent = job.stage
+                        ? `Processing documents... ${job.stage} (${job.progress}%)`
+                        : 'Waiting for a free worker...';
+                    await new Promise(resolve => setTimeout(resolve, 500));
+                }
+            } finally {
+                loadingText.textContent = 'Processing documents...';
+            }
+        }
+
         function detectArabic(text) {
             const arabicPattern = /[\u0600-\u06FF]/;
             return arabicPattern.test(text);
         }
 
         function displayComparison(result) {
+            startComparison(result);
+            currentEtag = result.etag;
+            
+            const arabic = result.tokens.some(token => detectArabic(token));
+            document.getElementById('doc1Content').classList.toggle('rtl', arabic);
+            document.getElementById('doc2Content').classList.toggle('rtl', arabic);
+            
+            setupVirtualPanel(1, result.doc1, result);
+            setupVirtualPanel(2, result.doc2, result);
+        }
+
+        function startComparison(result) {
             document.getElementById('doc1Title').textContent = result.doc1_name;
             document.getElementById('doc2Title').textContent = result.doc2_name;
             
             const doc1Content = document.getElementById('doc1Content');
             const doc2Content = document.getElementById('doc2Content');
             
-            doc1Content.innerHTML = result.doc1_html;
-            doc2Content.innerHTML = result.doc2_html;
-            
-            if (detectArabic(result.doc1_html) || detectArabic(result.doc2_html)) {
-                doc1Content.classList.add('rtl');
-                doc2Content.classList.add('rtl');
-            } else {
-                doc1Content.classList.remove('rtl');
-                doc2Content.classList.remove('rtl');
-            }
+            doc1Content.innerHTML = '';
+            doc2Content.innerHTML = '';
+            doc1Content.classList.remove('rtl');
+            doc2Content.classList.remove('rtl');
+            document.getElementById('refinePanel').style.display = 'none';
             
             const analyticsHTML = `
                 <div class="analytics-card">
@@ -262,6 +381,11 @@ HTML_TEMPLATE = """
                     <div class="value">${result.analytics.modified_words}</div>
                     <div class="label">words</div>
                 </div>
+                <div class="analytics-card formatted">
+                    <h4>Formatting</h4>
+                    <div class="value">${result.analytics.formatted_words || 0}</div>
+                    <div class="label">words</div>
+                </div>
             `;
             
             document.getElementById('analyticsPanel').innerHTML = analyticsHTML;
@@ -274,17 +398,107 @@ HTML_TEMPLATE = """
                 behavior: 'smooth',
                 block: 'start'
             });
+        }
+
+        const VIRTUAL_BLOCK_LINES = 100;
+        const ESTIMATED_LINE_HEIGHT = 24;
+        const virtualPanels = {};
+
+        function escapeHtml(token) {
+            return token.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+        }
+
+        function renderLines(state, start, count) {
+            const { ids, runs } = state.data;
+            const { tokens, statuses } = state.result;
+            const parts = [];
+            
+            for (let line = start; line < start + count; line++) {
+                parts.push(`<div class="content-line"><span class="line-number">${line + 1}</span><div class="line-content">`);
+                const lineIds = ids[line];
+                const lineRuns = runs[line];
+                let index = 0;
+                for (let r = 0; r < lineRuns.length; r += 2) {
+                    const status = statuses[lineRuns[r]];
+                    for (let end = index + lineRuns[r + 1]; index < end; index++) {
+                        const token = tokens[lineIds[index]];
+                        if (token.trim()) {
+                            parts.push(`<span class="word ${status}">${escapeHtml(token)}</span>`);
+                        } else {
+                            parts.push(token.replace(/ /g, '&nbsp;').replace(/\t/g, '&nbsp;&nbsp;&nbsp;&nbsp;'));
+                        }
+                    }
+                }
+                parts.push('</div></div>');
+            }
+            
+            return parts.join('');
+        }
+
+        function setupVirtualPanel(doc, data, result) {
+            const panel = document.getElementById(`doc${doc}Panel`);
+            const content = document.getElementById(`doc${doc}Content`);
+            const blocks = [];
+            const fragment = document.createDocumentFragment();
+            
+            for (let start = 0; start < data.ids.length; start += VIRTUAL_BLOCK_LINES) {
+                const count = Math.min(VIRTUAL_BLOCK_LINES, data.ids.length - start);
+                const element = document.createElement('div');
+                element.style.height = `${count * ESTIMATED_LINE_HEIGHT}px`;
+                fragment.appendChild(element);
+                blocks.push({ element, start, count, rendered: false });
+            }
+            
+            content.innerHTML = '';
+            content.appendChild(fragment);
+            virtualPanels[doc] = { panel, blocks, data, result };
+            renderVisibleBlocks(doc);
+        }
+
+        function renderVisibleBlocks(doc) {
+            const state = virtualPanels[doc];
+            if (!state) return;
             
-            const doc1Panel = document.getElementById('doc1Panel');
-            const doc2Panel = document.getElementById('doc2Panel');
-            doc1Panel.addEventListener('scroll', () => {
-                doc2Panel.scrollTop = doc1Panel.scrollTop;
+            const viewTop = state.panel.scrollTop - state.panel.clientHeight;
+            const viewBottom = state.panel.scrollTop + 2 * state.panel.clientHeight;
+            
+            state.blocks.forEach(block => {
+                const top = block.element.offsetTop;
+                const visible = top < viewBottom && top + block.element.offsetHeight > viewTop;
+                if (visible && !block.rendered) {
+                    block.element.innerHTML = renderLines(state, block.start, block.count);
+                    block.element.style.height = '';
+                    block.rendered = true;
+                } else if (!visible && block.rendered) {
+                    block.element.style.height = `${block.element.offsetHeight}px`;
+                    block.element.innerHTML = '';
+                    block.rendered = false;
+                }
             });
-            doc2Panel.addEventListener('scroll', () => {
-                doc1Panel.scrollTop = doc2Panel.scrollTop;
+        }
+
+        let renderScheduled = false;
+        function scheduleRender() {
+            if (renderScheduled) return;
+            renderScheduled = true;
+            requestAnimationFrame(() => {
+                renderScheduled = false;
+                renderVisibleBlocks(1);
+                renderVisibleBlocks(2);
             });
         }
 
+        const doc1Panel = document.getElementById('doc1Panel');
+        const doc2Panel = document.getElementById('doc2Panel');
+        doc1Panel.addEventListener('scroll', () => {
+            doc2Panel.scrollTop = doc1Panel.scrollTop;
+            scheduleRender();
+        });
+        doc2Panel.addEventListener('scroll', () => {
+            doc1Panel.scrollTop = doc2Panel.scrollTop;
+            scheduleRender();
+        });
+
         function showError(message) {
             document.getElementById('errorMessage').textContent = message;
             document.getElementById('errorModal').style.display = 'flex';
@@ -307,6 +521,7 @@ HTML_TEMPLATE = """
             const addedLines = lineDiffs.added || [];
             const removedLines = lineDiffs.removed || [];
             const modifiedLines = lineDiffs.modified || [];
+            const formattedLines = lineDiffs.formatted || [];
             
             let html = '';
             
@@ -337,7 +552,18 @@ HTML_TEMPLATE = """
                     <div class="diff-lines-section modified">
                         <h4>✏️ Modified (${modifiedLines.length} lines)</h4>
                         <div class="line-numbers">
-                            ${modifiedLines.map(line => `<span class="line-number-badge">Line ${line}</span>`).join('')}
+                            ${modifiedLines.map(line => `<span class="line-number-badge" data-line="${line}" title="Show character changes">Line ${line}</span>`).join('')}
+                        </div>
+                    </div>
+                `;
+            }
+            
+            if (formattedLines.length > 0) {
+                html += `
+                    <div class="diff-lines-section formatted">
+                        <h4>🎨 Formatting (${formattedLines.length} lines)</h4>
+                        <div class="line-numbers">
+                            ${formattedLines.map(line => `<span class="line-number-badge">Line ${line}</span>`).join('')}
                         </div>
                     </div>
                 `;
@@ -350,6 +576,37 @@ HTML_TEMPLATE = """
             container.innerHTML = html;
             document.getElementById('differencesSummary').style.display = 'block';
         }
+
+        document.getElementById('diffLinesContainer').addEventListener('click', function(e) {
+            const badge = e.target.closest('.line-number-badge[data-line]');
+            if (badge && currentEtag) {
+                refineLine(badge.dataset.line);
+            }
+        });
+
+        function renderSegments(segments) {
+            return segments.map(([status, text]) => `<span class="char ${status}">${escapeHtml(text)}</span>`).join('');
+        }
+
+        async function refineLine(line) {
+            const panel = document.getElementById('refinePanel');
+            try {
+                const result = await (await fetch(`/compare/${currentEtag}/lines/${line}?level=char`)).json();
+                if (!result.success) {
+                    showError(result.error || 'Could not load the changes of this line');
+                    return;
+                }
+                panel.innerHTML = `<h4>Line ${line}</h4>` + result.hunks.map(hunk => `
+                    <div class="refine-hunk">
+                        <div class="refine-side" dir="auto">${renderSegments(hunk.doc1.segments)}</div>
+                        <div class="refine-side" dir="auto">${renderSegments(hunk.doc2.segments)}</div>
+                    </div>
+                `).join('');
+                panel.style.display = 'block';
+            } catch (error) {
+                showError('Network error: ' + error.message);
+            }
+        }
     </script>
 </body>
 </html>
@@ -357,6 +614,8 @@ HTML_TEMPLATE = """
 
 def extract_text_from_docx(file_stream):
     """Extract text from .docx file"""
+    from docx import Document
+    
     try:
         doc = Document(file_stream)
         text = []
@@ -366,6 +625,7 @@ def extract_text_from_docx(file_stream):
         return '\n'.join(text)
     except Exception as e:
         try:
+            import docx2txt
             file_stream.seek(0)
             return docx2txt.process(file_stream)
         except:
@@ -381,195 +641,3610 @@ def tokenize_text(text):
         tokenized_lines.append(tokens)
     return tokenized_lines
 
-def compare_documents(doc1_tokens, doc2_tokens):
-    """Compare tokenized documents and return alignment information"""
-    flat_doc1 = [token for line in doc1_tokens for token in line]
-    flat_doc2 = [token for line in doc2_tokens for token in line]
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_BODY = W_NS + 'body'
+W_P = W_NS + 'p'
+W_R = W_NS + 'r'
+W_HYPERLINK = W_NS + 'hyperlink'
+W_TBL = W_NS + 'tbl'
+W_TR = W_NS + 'tr'
+W_TC = W_NS + 'tc'
+W_TXBX = W_NS + 'txbxContent'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+W_RUN_TEXT = {W_NS + 'tab': '\t', W_NS + 'ptab': '\t', W_NS + 'cr': '\n', W_NS + 'noBreakHyphen': '-'}
+
+def _run_text(run, parts):
+    for child in run:
+        if child.tag == W_NS + 't':
+            parts.append(child.text or '')
+        elif child.tag == W_NS + 'br':
+            if child.get(W_NS + 'type', 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        elif child.tag in W_RUN_TEXT:
+            parts.append(W_RUN_TEXT[child.tag])
+
+def _paragraph_text(paragraph):
+    parts = []
+    for child in paragraph:
+        if child.tag == W_R:
+            _run_text(child, parts)
+        elif child.tag == W_HYPERLINK:
+            for run in child.iter(W_R):
+                _run_text(run, parts)
+    return ''.join(parts)
+
+def _iter_docx(element, tag):
+    """Yield the descendants of element with `tag`, in document order.
+
+    mc:Fallback subtrees (the VML copy Word writes next to each modern text box)
+    are skipped, and so is the content of text boxes, which is yielded as
+    w:txbxContent elements but not searched.
+    """
+    for child in element:
+        if child.tag == MC_FALLBACK:
+            continue
+        if child.tag == tag:
+            yield child
+        if child.tag != W_TXBX:
+            yield from _iter_docx(child, tag)
+
+def iter_docx_paragraphs(file_stream):
+    """Yield the text of each body paragraph by incrementally parsing word/document.xml.
+
+    Text follows python-docx's `paragraph.text` (runs and hyperlink runs, with
+    tabs and line breaks mapped to characters). Finished body children are
+    discarded as parsing proceeds, so memory stays bounded on very large files.
+    """
+    with zipfile.ZipFile(file_stream) as archive, archive.open('word/document.xml') as xml_stream:
+        depth = 0
+        body = None
+        for event, element in ElementTree.iterparse(xml_stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if element.tag == W_BODY and depth == 2:
+                    body = element
+                continue
+            
+            depth -= 1
+            if depth != 2 or body is None:
+                continue
+            
+            if element.tag == W_P:
+                yield _paragraph_text(element)
+            body.clear()
+
+def extract_docx_streaming(file_stream):
+    """Extract and tokenize a .docx in one streaming pass, returning (text, tokenized_lines)"""
+    try:
+        paragraphs = []
+        tokenized_lines = []
+        for paragraph in iter_docx_paragraphs(file_stream):
+            if paragraph.strip():
+                paragraphs.append(paragraph)
+                tokenized_lines.extend(tokenize_text(paragraph))
+        return '\n'.join(paragraphs), tokenized_lines or [[]]
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise Exception(f"Failed to parse DOCX file: {str(e)}")
+
+SECTION_PARTS = (
+    ('headers', 'header', re.compile(r'word/header\d*\.xml$')),
+    ('footers', 'footer', re.compile(r'word/footer\d*\.xml$')),
+)
+NOTE_PARTS = (
+    ('footnotes', 'footnote', 'word/footnotes.xml', W_NS + 'footnote'),
+    ('endnotes', 'endnote', 'word/endnotes.xml', W_NS + 'endnote'),
+    ('comments', 'comment', 'word/comments.xml', W_NS + 'comment'),
+)
+
+def extract_docx_sections(file_stream):
+    """Extract a .docx as typed blocks grouped into independently diffed sections.
+
+    Returns a list of [section_name, blocks]. Each block is a dict with `type`
+    and `text`, plus `row`/`col` for table cells and otherwise its 1-based
+    `index` among the non-empty blocks of its section, and `id` for notes
+    and comments. Sections are the body paragraphs, one section per top-level
+    table, text boxes, headers, footers, footnotes, endnotes and comments.
+    Text box content only counts in the text box section, once per text box.
+    """
+    try:
+        with zipfile.ZipFile(file_stream) as archive:
+            names = sorted(archive.namelist())
+            body = ElementTree.fromstring(archive.read('word/document.xml')).find(W_BODY)
+            
+            paragraphs = []
+            tables = []
+            for child in body:
+                if child.tag == W_P:
+                    text = _paragraph_text(child)
+                    if text.strip():
+                        paragraphs.append({'type': 'paragraph', 'text': text})
+                elif child.tag == W_TBL:
+                    cells = []
+                    for row_index, row in enumerate(child.findall(W_TR), 1):
+                        for col_index, cell in enumerate(row.findall(W_TC), 1):
+                            text = '\n'.join(_paragraph_text(p) for p in _iter_docx(cell, W_P))
+                            cells.append({'type': 'table_cell', 'row': row_index, 'col': col_index, 'text': text})
+                    tables.append([f'table-{len(tables) + 1}', cells])
+            
+            textboxes = []
+            
+            def add_textboxes(root):
+                for textbox in _iter_docx(root, W_TXBX):
+                    textboxes.extend({'type': 'textbox', 'text': text}
+                                     for text in map(_paragraph_text, _iter_docx(textbox, W_P)) if text.strip())
+            
+            add_textboxes(body)
+            sections = [['body', paragraphs]] + tables
+            sections.append(['textboxes', textboxes])
+            
+            for section_name, block_type, pattern in SECTION_PARTS:
+                blocks = []
+                for name in names:
+                    if pattern.match(name):
+                        root = ElementTree.fromstring(archive.read(name))
+                        blocks.extend({'type': block_type, 'text': text}
+                                      for text in map(_paragraph_text, _iter_docx(root, W_P)) if text.strip())
+                        add_textboxes(root)
+                sections.append([section_name, blocks])
+            
+            for section_name, block_type, part, tag in NOTE_PARTS:
+                blocks = []
+                if part in names:
+                    for note in ElementTree.fromstring(archive.read(part)).findall(tag):
+                        if note.get(W_NS + 'type') in (None, 'normal'):
+                            text = '\n'.join(_paragraph_text(p) for p in _iter_docx(note, W_P))
+                            blocks.append({'type': block_type, 'id': note.get(W_NS + 'id'), 'text': text})
+                sections.append([section_name, blocks])
+            
+            for section_name, blocks in sections:
+                if not section_name.startswith('table-'):
+                    for index, block in enumerate(blocks, 1):
+                        block['index'] = index
+            
+            return sections
+    except (zipfile.BadZipFile, KeyError, AttributeError, ElementTree.ParseError) as e:
+        raise Exception(f"Failed to parse DOCX file: {str(e)}")
+
+RUN_FORMAT_PROPERTIES = ('bold', 'italic', 'underline', 'strike', 'double_strike', 'name', 'size',
+                         'highlight_color', 'superscript', 'subscript', 'all_caps', 'small_caps')
+
+def format_signature(values):
+    """Hash a sequence of formatting values into a signed 64-bit integer"""
+    digest = hashlib.blake2b(repr(tuple(values)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def run_signature(run):
+    """Return the formatting signature of a python-docx run: its direct font properties and character style"""
+    font = run.font
+    values = [getattr(font, name) for name in RUN_FORMAT_PROPERTIES]
+    values.extend((font.color.rgb, font.color.theme_color, run.style.name if run.style is not None else None))
+    return format_signature(values)
+
+def _span_signature(run_ends, run_signatures, start, end):
+    """Signature of the characters start..end of a paragraph, combining runs when a token spans several"""
+    first = bisect_right(run_ends, start)
+    last = bisect_right(run_ends, end - 1)
+    spanned = run_signatures[first:last + 1]
+    if all(signature == spanned[0] for signature in spanned):
+        return spanned[0]
+    return format_signature(spanned)
+
+def extract_docx_formatting(file_stream):
+    """Extract text, tokens and per-token formatting signatures with python-docx.
+
+    Paragraph text is assembled from the runs and hyperlink runs, matching
+    `paragraph.text`. Every token gets the signature of the run it falls in,
+    so formatting equality is a single integer compare. Returns
+    (text, tokenized_lines, signatures) with one signature per token in order.
+    """
+    from docx import Document
     
-    matcher = SequenceMatcher(None, flat_doc1, flat_doc2)
-    aligned_doc1 = []
-    aligned_doc2 = []
+    try:
+        doc = Document(file_stream)
+    except Exception as e:
+        raise Exception(f"Failed to parse DOCX file: {str(e)}")
     
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        if tag == 'equal':
-            aligned_doc1.extend([(token, 'same') for token in flat_doc1[i1:i2]])
-            aligned_doc2.extend([(token, 'same') for token in flat_doc2[j1:j2]])
-        elif tag == 'replace':
-            aligned_doc1.extend([(token, 'different') for token in flat_doc1[i1:i2]])
-            aligned_doc2.extend([(token, 'different') for token in flat_doc2[j1:j2]])
-        elif tag == 'delete':
-            aligned_doc1.extend([(token, 'missing') for token in flat_doc1[i1:i2]])
-            aligned_doc2.extend([('', 'missing') for _ in range(i2 - i1)])
-        elif tag == 'insert':
-            aligned_doc1.extend([('', 'missing') for _ in range(j2 - j1)])
-            aligned_doc2.extend([(token, 'added') for token in flat_doc2[j1:j2]])
-    
-    def reconstruct_lines(aligned_tokens, original_lines):
-        result_lines = []
-        token_index = 0
-        
-        for original_line in original_lines:
-            line_tokens = []
-            for original_token in original_line:
-                if token_index < len(aligned_tokens):
-                    token, status = aligned_tokens[token_index]
-                    line_tokens.append((token, status))
-                    token_index += 1
-                else:
-                    line_tokens.append(('', 'missing'))
-            
-            while (token_index < len(aligned_tokens) and 
-                   aligned_tokens[token_index][0] in [' ', '\t']):
-                token, status = aligned_tokens[token_index]
-                line_tokens.append((token, status))
-                token_index += 1
-                
-            result_lines.append(line_tokens)
+    paragraphs = []
+    tokenized_lines = []
+    signatures = []
+    for paragraph in doc.paragraphs:
+        runs = []
+        for item in paragraph.iter_inner_content():
+            runs.extend(getattr(item, 'runs', [item]))
+        run_texts = [run.text for run in runs]
+        text = ''.join(run_texts)
+        if not text.strip():
+            continue
         
-        if token_index < len(aligned_tokens):
-            result_lines.append([(token, status) for token, status in aligned_tokens[token_index:]])
+        run_ends = []
+        length = 0
+        for run_text in run_texts:
+            length += len(run_text)
+            run_ends.append(length)
+        run_signatures = [run_signature(run) for run in runs]
         
-        return result_lines
-    
-    doc1_aligned = reconstruct_lines(aligned_doc1, doc1_tokens)
-    doc2_aligned = reconstruct_lines(aligned_doc2, doc2_tokens)
+        lines = tokenize_text(text)
+        offset = 0
+        for line_text, line_tokens in zip(text.split('\n'), lines):
+            position = offset
+            for token in line_tokens:
+                signatures.append(_span_signature(run_ends, run_signatures, position, position + len(token)))
+                position += len(token)
+            offset += len(line_text) + 1
+        
+        paragraphs.append(text)
+        tokenized_lines.extend(lines)
     
-    return doc1_aligned, doc2_aligned
+    return '\n'.join(paragraphs), tokenized_lines or [[]], signatures
 
-def generate_html_content(aligned_lines):
-    """Generate HTML content with line numbers and colored tokens"""
-    html_lines = []
+EXTRACTORS = ('python-docx', 'stream')
+DEFAULT_EXTRACTOR = os.environ.get('XSUKAX_EXTRACTOR', 'python-docx')
+
+class ContentCache:
+    """Bounded LRU cache keyed by content hash, with an optional SQLite tier.
+
+    Values must be JSON-serialisable. Entries older than `ttl` seconds are
+    treated as missing (a `ttl` of 0 disables expiry). When `db_path` is set,
+    evicted and cold entries are still served from the on-disk table.
+    """
     
-    for line_num, line_tokens in enumerate(aligned_lines, 1):
-        line_html = f'<div class="content-line"><span class="line-number">{line_num}</span><div class="line-content">'
-        
-        for token, status in line_tokens:
-            if token.strip():
-                escaped_token = token.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                line_html += f'<span class="word {status}">{escaped_token}</span>'
-            else:
-                line_html += token.replace(' ', '&nbsp;').replace('\t', '&nbsp;&nbsp;&nbsp;&nbsp;')
+    def __init__(self, name, max_entries=64, ttl=0, db_path=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
         
-        line_html += '</div></div>'
-        html_lines.append(line_html)
-    
-    return ''.join(html_lines)
-
-def analyze_line_differences(doc1_aligned, doc2_aligned):
-    """Analyze which lines contain differences"""
-    added_lines = []
-    removed_lines = []
-    modified_lines = []
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.name}" '
+                             '(key TEXT PRIMARY KEY, stored_at REAL, value TEXT)')
     
-    max_lines = max(len(doc1_aligned), len(doc2_aligned))
+    def _expired(self, stored_at):
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
     
-    for line_num in range(max_lines):
-        doc1_line = doc1_aligned[line_num] if line_num < len(doc1_aligned) else []
-        doc2_line = doc2_aligned[line_num] if line_num < len(doc2_aligned) else []
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
         
-        doc1_has_diff = any(status in ['different', 'missing'] for token, status in doc1_line if token.strip())
-        doc2_has_diff = any(status in ['different', 'added'] for token, status in doc2_line if token.strip())
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                row = conn.execute(f'SELECT stored_at, value FROM "{self.name}" WHERE key = ?', (key,)).fetchone()
+                if row is not None and self._expired(row[0]):
+                    conn.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (key,))
+                    row = None
+            if row is not None:
+                value = json.loads(row[1])
+                with self._lock:
+                    self.disk_hits += 1
+                    self._store(key, row[0], value)
+                return value
         
-        doc1_has_missing = any(status == 'missing' for token, status in doc1_line if token.strip())
-        doc2_has_added = any(status == 'added' for token, status in doc2_line if token.strip())
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key, value):
+        stored_at = time.time()
+        with self._lock:
+            self._store(key, stored_at, value)
         
-        if doc1_has_missing and doc2_has_added:
-            if not any(status == 'different' for token, status in doc1_line if token.strip()):
-                if doc1_has_missing:
-                    removed_lines.append(line_num + 1)
-                if doc2_has_added:
-                    added_lines.append(line_num + 1)
-            else:
-                modified_lines.append(line_num + 1)
-        elif doc1_has_diff or doc2_has_diff:
-            modified_lines.append(line_num + 1)
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(f'INSERT OR REPLACE INTO "{self.name}" (key, stored_at, value) VALUES (?, ?, ?)',
+                             (key, stored_at, json.dumps(value)))
     
-    return {
-        'added': sorted(set(added_lines)),
-        'removed': sorted(set(removed_lines)),
-        'modified': sorted(set(modified_lines))
-    }
+    def _store(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (key,))
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_path:
+            with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                conn.execute(f'DELETE FROM "{self.name}"')
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'disk_tier': bool(self.db_path),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups * 100, 1) if lookups else 0.0
+            }
 
-def calculate_analytics(doc1_aligned, doc2_aligned):
-    """Calculate detailed comparison analytics"""
-    total_words_doc1 = sum(len([t for t, s in line if t.strip()]) for line in doc1_aligned)
-    total_words_doc2 = sum(len([t for t, s in line if t.strip()]) for line in doc2_aligned)
+document_cache = ContentCache(
+    'documents',
+    max_entries=int(os.environ.get('XSUKAX_CACHE_SIZE', 64)),
+    ttl=float(os.environ.get('XSUKAX_CACHE_TTL', 3600)),
+    db_path=os.environ.get('XSUKAX_CACHE_DB') or None
+)
+
+# Hunk locators for refinement, built from compact results on first use
+alignment_cache = ContentCache(
+    'alignments',
+    max_entries=int(os.environ.get('XSUKAX_ALIGNMENT_CACHE_SIZE', 8)),
+    ttl=float(os.environ.get('XSUKAX_CACHE_TTL', 3600))
+)
+
+result_cache = ContentCache(
+    'results',
+    max_entries=int(os.environ.get('XSUKAX_RESULT_CACHE_SIZE', 32)),
+    ttl=float(os.environ.get('XSUKAX_CACHE_TTL', 3600)),
+    db_path=os.environ.get('XSUKAX_CACHE_DB') or None
+)
+
+def _no_progress(stage):
+    pass
+
+def spooled_file():
+    """Temporary file kept in memory up to SPOOL_MEMORY_BYTES, then rolled over to disk in SPOOL_DIR"""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES, dir=SPOOL_DIR)
+
+def spool_upload(upload):
+    """Copy an uploaded file into a spooled temporary file that outlives the request"""
+    spooled = spooled_file()
+    shutil.copyfileobj(upload.stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+def stream_digest(file_stream):
+    """SHA-256 of a seekable stream read in chunks, leaving the stream rewound for extraction"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_stream.read(1 << 20), b''):
+        digest.update(chunk)
+    file_stream.seek(0)
+    return digest.hexdigest()
+
+def check_document_size(tokens):
+    """Raise LimitExceeded when a document has more words than MAX_DOCUMENT_WORDS allows"""
+    if not MAX_DOCUMENT_WORDS:
+        return
+    words = sum(1 for line in tokens for token in line if not token.isspace())
+    if words > MAX_DOCUMENT_WORDS:
+        metrics.inc('xsukax_limit_rejections_total', limit='words')
+        raise LimitExceeded(f'Document has {words} words, above the limit of {MAX_DOCUMENT_WORDS}')
+
+def load_document(file_stream, progress=_no_progress, extractor=None):
+    """Extract and tokenize an uploaded document, reusing cached results by SHA-256 of its bytes.
+
+    The stream must be seekable; it is hashed in chunks and only parsed on a
+    cache miss, so uploads spooled to disk are never read into memory whole.
+    `progress` is called with the name of each pipeline stage as it starts.
+    `extractor` is one of EXTRACTORS and defaults to DEFAULT_EXTRACTOR.
+    """
+    extractor = extractor or DEFAULT_EXTRACTOR
+    if extractor not in EXTRACTORS:
+        raise ValueError(f"Unknown extractor: {extractor}")
     
-    removed_words = sum(len([t for t, s in line if t.strip() and s == 'missing']) for line in doc1_aligned)
-    added_words = sum(len([t for t, s in line if t.strip() and s == 'added']) for line in doc2_aligned)
-    modified_words = sum(len([t for t, s in line if t.strip() and s == 'different']) for line in doc1_aligned)
+    digest = stream_digest(file_stream)
     
-    same_words = sum(len([t for t, s in line if t.strip() and s == 'same']) for line in doc1_aligned)
-    total_words = max(total_words_doc1, total_words_doc2)
+    cache_key = f'{extractor}:{digest}'
+    cached = document_cache.get(cache_key)
+    if cached is None:
+        progress('extract')
+        if extractor == 'stream':
+            text, tokens = extract_docx_streaming(file_stream)
+        else:
+            text = extract_text_from_docx(file_stream)
+            progress('tokenize')
+            tokens = tokenize_text(text)
+        cached = {'text': text, 'tokens': tokens}
+        document_cache.put(cache_key, cached)
     
-    similarity = round((same_words / total_words * 100) if total_words > 0 else 100, 1)
+    check_document_size(cached['tokens'])
+    return digest, cached['text'], cached['tokens']
+
+def load_document_sections(file_stream):
+    """Extract the sections of an uploaded document, cached by SHA-256 of its bytes"""
+    digest = stream_digest(file_stream)
     
-    return {
-        'total_words': total_words,
-        'added_words': added_words,
-        'removed_words': removed_words,
-        'modified_words': modified_words,
-        'similarity': similarity
-    }
+    cache_key = f'sections:{digest}'
+    sections = document_cache.get(cache_key)
+    if sections is None:
+        sections = extract_docx_sections(file_stream)
+        document_cache.put(cache_key, sections)
+    
+    check_document_size([block['text'].split() for _, blocks in sections for block in blocks])
+    return digest, sections
 
-@app.route('/')
-def index():
-    """Main page"""
-    return render_template_string(HTML_TEMPLATE)
+def load_document_formatting(file_stream, progress=_no_progress):
+    """Extract an uploaded document with its formatting signatures, cached by SHA-256 of its bytes.
 
-@app.route('/compare', methods=['POST'])
-def compare():
-    """Handle document comparison"""
-    try:
-        if 'doc1' not in request.files or 'doc2' not in request.files:
-            return jsonify({'success': False, 'error': 'Please upload both documents'})
+    Returns (digest, text, tokens, signatures).
+    """
+    digest = stream_digest(file_stream)
+    
+    cache_key = f'formatting:{digest}'
+    cached = document_cache.get(cache_key)
+    if cached is None:
+        progress('extract')
+        text, tokens, signatures = extract_docx_formatting(file_stream)
+        cached = {'text': text, 'tokens': tokens, 'signatures': signatures}
+        document_cache.put(cache_key, cached)
+    
+    check_document_size(cached['tokens'])
+    return digest, cached['text'], cached['tokens'], cached['signatures']
+
+def benchmark_extractors(paths, repeat=3):
+    """Time every extractor on the given files and report the best run in milliseconds"""
+    report = []
+    for path in paths:
+        with open(path, 'rb') as stream:
+            data = stream.read()
         
-        doc1_file = request.files['doc1']
-        doc2_file = request.files['doc2']
+        timings = {}
+        for extractor in EXTRACTORS:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                if extractor == 'stream':
+                    extract_docx_streaming(io.BytesIO(data))
+                else:
+                    tokenize_text(extract_text_from_docx(io.BytesIO(data)))
+                elapsed = (time.perf_counter() - started) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            timings[extractor] = round(best, 2)
         
-        if doc1_file.filename == '' or doc2_file.filename == '':
-            return jsonify({'success': False, 'error': 'Please select both files'})
+        report.append({
+            'file': path,
+            'bytes': len(data),
+            'timings': timings,
+            'speedup': round(timings['python-docx'] / timings['stream'], 2) if timings['stream'] else None
+        })
+    return report
+
+HISTOGRAM_MAX_CHAIN = 64
+
+def opcodes_from_blocks(matching_blocks, len_a, len_b):
+    """Convert (i, j, size) matching blocks into SequenceMatcher-style opcodes"""
+    merged = []
+    for ai, bj, size in sorted(matching_blocks):
+        if merged and merged[-1][0] + merged[-1][2] == ai and merged[-1][1] + merged[-1][2] == bj:
+            merged[-1][2] += size
+        elif size:
+            merged.append([ai, bj, size])
+    
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in merged + [(len_a, len_b, 0)]:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+def difflib_opcodes(seq_a, seq_b):
+    """Diff two sequences with difflib's SequenceMatcher (junk heuristic disabled)"""
+    return SequenceMatcher(None, seq_a, seq_b, autojunk=False).get_opcodes()
+
+def _myers_split(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi):
+    """Find the middle snake of an O(ND) Myers search and return its split point.
+
+    Forward and reverse searches run simultaneously over two V arrays whose size
+    is linear in the region length. Returns None when the regions share nothing.
+    """
+    len_a = a_hi - a_lo
+    len_b = b_hi - b_lo
+    max_d = (len_a + len_b + 1) // 2
+    v_offset = max_d + 1
+    v_length = 2 * max_d + 3
+    v1 = [-1] * v_length
+    v2 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2[v_offset + 1] = 0
+    delta = len_a - len_b
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    
+    for d in range(max_d + 1):
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < len_a and y1 < len_b and seq_a[a_lo + x1] == seq_b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > len_a:
+                k1end += 2
+            elif y1 > len_b:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= len_a - v2[k2_offset]:
+                        return x1, y1
         
-        if not doc1_file.filename.lower().endswith('.docx') or not doc2_file.filename.lower().endswith('.docx'):
-            return jsonify({'success': False, 'error': 'Only .docx files are supported'})
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < len_a and y2 < len_b and seq_a[a_hi - x2 - 1] == seq_b[b_hi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > len_a:
+                k2end += 2
+            elif y2 > len_b:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= len_a - x2:
+                        return x1, v_offset + x1 - k1_offset
+    return None
+
+def _myers_blocks(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi, blocks):
+    """Append the matching blocks of a linear-space Myers diff over the given regions"""
+    stack = [(a_lo, a_hi, b_lo, b_hi)]
+    
+    while stack:
+        a_lo, a_hi, b_lo, b_hi = stack.pop()
         
-        doc1_text = extract_text_from_docx(doc1_file.stream)
-        doc2_text = extract_text_from_docx(doc2_file.stream)
+        start_a, start_b = a_lo, b_lo
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_lo] == seq_b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        blocks.append((start_a, start_b, a_lo - start_a))
         
-        doc1_tokens = tokenize_text(doc1_text)
-        doc2_tokens = tokenize_text(doc2_text)
+        end_a = a_hi
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_hi - 1] == seq_b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        blocks.append((a_hi, b_hi, end_a - a_hi))
         
-        doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens)
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
         
-        doc1_html = generate_html_content(doc1_aligned)
-        doc2_html = generate_html_content(doc2_aligned)
+        split = _myers_split(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi)
+        if split is None:
+            continue
+        x, y = split
+        if (x, y) in ((0, 0), (a_hi - a_lo, b_hi - b_lo)):
+            continue
+        stack.append((a_lo + x, a_hi, b_lo + y, b_hi))
+        stack.append((a_lo, a_lo + x, b_lo, b_lo + y))
+
+def myers_opcodes(seq_a, seq_b):
+    """Diff two sequences with Myers' O(ND) algorithm in linear space"""
+    blocks = []
+    _myers_blocks(seq_a, 0, len(seq_a), seq_b, 0, len(seq_b), blocks)
+    return opcodes_from_blocks(blocks, len(seq_a), len(seq_b))
+
+def histogram_opcodes(seq_a, seq_b):
+    """Diff two sequences with the histogram algorithm.
+
+    Each region is split around the longest common run seeded by the item that
+    occurs least often in the old side. Items occurring more than
+    HISTOGRAM_MAX_CHAIN times are never used as seeds; regions without a usable
+    seed fall back to Myers.
+    """
+    blocks = []
+    stack = [(0, len(seq_a), 0, len(seq_b))]
+    
+    while stack:
+        a_lo, a_hi, b_lo, b_hi = stack.pop()
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
         
-        analytics = calculate_analytics(doc1_aligned, doc2_aligned)
-        line_differences = analyze_line_differences(doc1_aligned, doc2_aligned)
+        occurrences = {}
+        for i in range(a_lo, a_hi):
+            occurrences.setdefault(seq_a[i], []).append(i)
         
-        return jsonify({
-            'success': True,
-            'doc1_name': doc1_file.filename,
-            'doc2_name': doc2_file.filename,
-            'doc1_html': doc1_html,
-            'doc2_html': doc2_html,
-            'analytics': analytics,
-            'line_differences': line_differences
-        })
+        best = None
+        best_count = HISTOGRAM_MAX_CHAIN
+        best_length = 0
+        j = b_lo
+        while j < b_hi:
+            positions = occurrences.get(seq_b[j])
+            if positions is None or len(positions) > best_count:
+                j += 1
+                continue
+            
+            next_j = j + 1
+            for i in positions:
+                start_i, start_j = i, j
+                while start_i > a_lo and start_j > b_lo and seq_a[start_i - 1] == seq_b[start_j - 1]:
+                    start_i -= 1
+                    start_j -= 1
+                end_i, end_j = i + 1, j + 1
+                while end_i < a_hi and end_j < b_hi and seq_a[end_i] == seq_b[end_j]:
+                    end_i += 1
+                    end_j += 1
+                
+                length = end_i - start_i
+                if len(positions) < best_count or length > best_length:
+                    best = (start_i, start_j, length)
+                    best_count = len(positions)
+                    best_length = length
+                next_j = max(next_j, end_j)
+            j = next_j
         
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        if best is None:
+            _myers_blocks(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi, blocks)
+            continue
+        
+        start_i, start_j, length = best
+        blocks.append(best)
+        stack.append((start_i + length, a_hi, start_j + length, b_hi))
+        stack.append((a_lo, start_i, b_lo, start_j))
+    
+    return opcodes_from_blocks(blocks, len(seq_a), len(seq_b))
 
-if __name__ == '__main__':
-    try:
-        pythoncom.CoInitialize()
-    except:
-        pass
+def patience_opcodes(seq_a, seq_b):
+    """Diff two sequences of hashable items with the patience algorithm.
+
+    Items that occur exactly once on both sides are used as anchors; the longest
+    increasing run of anchors splits the problem into independent gaps which are
+    processed the same way. Gaps without unique anchors fall back to Myers.
+    """
+    blocks = []
+    stack = [(0, len(seq_a), 0, len(seq_b))]
     
-    print("=" * 60)
-    print("xsukax Word Document Comparator")
-    print("=" * 60)
-    print("Server running at: http://localhost:5000")
-    print("Press CTRL+C to stop the server")
-    print("=" * 60)
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    while stack:
+        a_lo, a_hi, b_lo, b_hi = stack.pop()
+        
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_lo] == seq_b[b_lo]:
+            blocks.append((a_lo, b_lo, 1))
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_hi - 1] == seq_b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            blocks.append((a_hi, b_hi, 1))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        
+        counts = {}
+        for i in range(a_lo, a_hi):
+            entry = counts.setdefault(seq_a[i], [0, i, 0, 0])
+            entry[0] += 1
+        for j in range(b_lo, b_hi):
+            entry = counts.get(seq_b[j])
+            if entry is not None:
+                entry[2] += 1
+                entry[3] = j
+        
+        anchors = sorted((entry[1], entry[3]) for entry in counts.values() if entry[0] == 1 and entry[2] == 1)
+        
+        if not anchors:
+            _myers_blocks(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi, blocks)
+            continue
+        
+        # Longest increasing subsequence of the b-positions (patience sorting)
+        tails = []
+        tail_idx = []
+        prev = [-1] * len(anchors)
+        for k, (_, j) in enumerate(anchors):
+            pos = bisect_left(tails, j)
+            if pos == len(tails):
+                tails.append(j)
+                tail_idx.append(k)
+            else:
+                tails[pos] = j
+                tail_idx[pos] = k
+            prev[k] = tail_idx[pos - 1] if pos > 0 else -1
+        
+        chain = []
+        k = tail_idx[-1]
+        while k != -1:
+            chain.append(anchors[k])
+            k = prev[k]
+        chain.reverse()
+        
+        for i, j in chain:
+            blocks.append((i, j, 1))
+            stack.append((a_lo, i, b_lo, j))
+            a_lo, b_lo = i + 1, j + 1
+        stack.append((a_lo, a_hi, b_lo, b_hi))
+    
+    return opcodes_from_blocks(blocks, len(seq_a), len(seq_b))
+
+DIFF_BACKENDS = {
+    'difflib': difflib_opcodes,
+    'myers': myers_opcodes,
+    'histogram': histogram_opcodes,
+    'patience': patience_opcodes,
+}
+DEFAULT_DIFF_BACKEND = 'difflib'
+
+STREAM_BLOCK_LINES = 200
+
+STATUS_NAMES = ('same', 'different', 'missing', 'added', 'formatted')
+STATUS_SAME, STATUS_DIFFERENT, STATUS_MISSING, STATUS_ADDED, STATUS_FORMATTED = range(len(STATUS_NAMES))
+
+NORMALIZATIONS = ('case', 'whitespace', 'diacritics')
+
+# Arabic tatweel, harakat, Quranic annotation marks and superscript alef
+ARABIC_MARKS = dict.fromkeys(
+    [0x0640, 0x0670] + list(range(0x0610, 0x061B)) + list(range(0x064B, 0x0660))
+    + [code for code in range(0x06D6, 0x06EE) if code not in (0x06DD, 0x06DE, 0x06E5, 0x06E6, 0x06E9)]
+)
+
+def parse_normalization(values):
+    """Turn normalization names (a list, or comma-separated strings) into a sorted tuple"""
+    names = {name.strip() for value in values for name in value.split(',') if name.strip()}
+    unknown = names.difference(NORMALIZATIONS)
+    if unknown:
+        raise ValueError(f"Unknown normalization: {', '.join(sorted(unknown))}")
+    return tuple(sorted(names))
+
+def normalize_token(token, normalize):
+    """Return the comparison key text of `token`; whitespace collapses to '' under `whitespace`"""
+    if 'whitespace' in normalize and token.isspace():
+        return ''
+    if 'case' in normalize:
+        token = token.casefold()
+    if 'diacritics' in normalize:
+        token = token.translate(ARABIC_MARKS)
+    return token
+
+class TokenTable:
+    """Interns token strings to integer ids shared by both sides of a comparison.
+
+    With `normalize` options, every new token also gets a comparison key id in
+    `keys`: tokens that only differ in case or diacritics share a key, and
+    whitespace has key 0 when whitespace is collapsed.
+    """
+    
+    def __init__(self, normalize=()):
+        self.ids = {'': 0}
+        self.tokens = ['']
+        self.normalize = normalize
+        self.keys = array('i', [0]) if normalize else None
+        self._key_ids = {'': 0}
+    
+    def intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+            if self.keys is not None:
+                key = normalize_token(token, self.normalize)
+                self.keys.append(self._key_ids.setdefault(key, len(self._key_ids)))
+        return token_id
+    
+    def intern_lines(self, tokenized_lines):
+        """Return a flat array of token ids and an array of line start offsets"""
+        token_ids = array('i')
+        line_starts = array('i', [0])
+        for line in tokenized_lines:
+            token_ids.extend([self.intern(token) for token in line])
+            line_starts.append(len(token_ids))
+        return token_ids, line_starts
+
+class AlignedLines:
+    """Aligned tokens of one document stored as parallel id and status arrays.
+
+    Behaves like the list of lines of (token, status) pairs consumed by the
+    rendering and analytics functions, materialising strings one line at a time.
+    """
+    
+    __slots__ = ('table', 'token_ids', 'statuses', 'line_starts')
+    
+    def __init__(self, table, token_ids, statuses, line_starts):
+        self.table = table
+        self.token_ids = token_ids
+        self.statuses = statuses
+        self.line_starts = line_starts
+    
+    def __len__(self):
+        return len(self.line_starts) - 1
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        
+        start, end = self.line_starts[index], self.line_starts[index + 1]
+        tokens = self.table.tokens
+        return [(tokens[token_id], STATUS_NAMES[status])
+                for token_id, status in zip(self.token_ids[start:end], self.statuses[start:end])]
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+def align_tokens(hunk_doc1, hunk_doc2, opcodes, aligned_doc1, aligned_doc2):
+    """Append token ids and status codes for each opcode to the aligned (ids, statuses) pairs"""
+    ids1, statuses1 = aligned_doc1
+    ids2, statuses2 = aligned_doc2
+    
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            ids1.extend(hunk_doc1[i1:i2])
+            statuses1.extend(bytes((STATUS_SAME,)) * (i2 - i1))
+            ids2.extend(hunk_doc2[j1:j2])
+            statuses2.extend(bytes((STATUS_SAME,)) * (j2 - j1))
+        elif tag == 'replace':
+            ids1.extend(hunk_doc1[i1:i2])
+            statuses1.extend(bytes((STATUS_DIFFERENT,)) * (i2 - i1))
+            ids2.extend(hunk_doc2[j1:j2])
+            statuses2.extend(bytes((STATUS_DIFFERENT,)) * (j2 - j1))
+        elif tag == 'delete':
+            ids1.extend(hunk_doc1[i1:i2])
+            statuses1.extend(bytes((STATUS_MISSING,)) * (i2 - i1))
+            ids2.extend(bytes(i2 - i1))
+            statuses2.extend(bytes((STATUS_MISSING,)) * (i2 - i1))
+        elif tag == 'insert':
+            ids1.extend(bytes(j2 - j1))
+            statuses1.extend(bytes((STATUS_MISSING,)) * (j2 - j1))
+            ids2.extend(hunk_doc2[j1:j2])
+            statuses2.extend(bytes((STATUS_ADDED,)) * (j2 - j1))
+
+def align_words(hunk_doc1, hunk_doc2, word_positions, opcodes, aligned_doc1, aligned_doc2):
+    """Like align_tokens for opcodes computed on words only, reattaching the whitespace in between.
+
+    `word_positions` holds the hunk offsets of the matched tokens of each
+    document. Whitespace before a changed word takes that word's status.
+    Around equal words it is paired up as `same`, and whitespace present on
+    one side only becomes missing/added, which the word-level analytics and
+    the rendering ignore. `same` tokens therefore still pair up in order.
+    """
+    doc1_positions, doc2_positions = word_positions
+    ids1, statuses1 = aligned_doc1
+    ids2, statuses2 = aligned_doc2
+    
+    def pair_whitespace(gap1, gap2):
+        paired = min(len(gap1), len(gap2))
+        ids1.extend(gap1)
+        statuses1.extend(bytes((STATUS_SAME,)) * paired + bytes((STATUS_MISSING,)) * (len(gap1) - paired))
+        ids2.extend(gap2)
+        statuses2.extend(bytes((STATUS_SAME,)) * paired + bytes((STATUS_ADDED,)) * (len(gap2) - paired))
+    
+    cursor1 = cursor2 = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            for position1, position2 in zip(doc1_positions[i1:i2], doc2_positions[j1:j2]):
+                pair_whitespace(hunk_doc1[cursor1:position1], hunk_doc2[cursor2:position2])
+                ids1.append(hunk_doc1[position1])
+                statuses1.append(STATUS_SAME)
+                ids2.append(hunk_doc2[position2])
+                statuses2.append(STATUS_SAME)
+                cursor1, cursor2 = position1 + 1, position2 + 1
+        else:
+            end1 = doc1_positions[i2 - 1] + 1 if i2 > i1 else cursor1
+            end2 = doc2_positions[j2 - 1] + 1 if j2 > j1 else cursor2
+            align_tokens(hunk_doc1[cursor1:end1], hunk_doc2[cursor2:end2],
+                         [(tag, 0, end1 - cursor1, 0, end2 - cursor2)], aligned_doc1, aligned_doc2)
+            cursor1, cursor2 = end1, end2
+    
+    pair_whitespace(hunk_doc1[cursor1:], hunk_doc2[cursor2:])
+
+def reconstruct_lines(aligned_ids, original_starts, table):
+    """Split aligned token ids back into lines following the original line lengths.
+
+    Each original line takes as many aligned tokens as it originally had plus
+    any trailing space/tab tokens; anything left over forms a final line.
+    """
+    blank_ids = {table.ids.get(' '), table.ids.get('\t')}
+    total = len(aligned_ids)
+    line_starts = array('i', [0])
+    token_index = 0
+    
+    for line in range(len(original_starts) - 1):
+        token_index = min(token_index + original_starts[line + 1] - original_starts[line], total)
+        while token_index < total and aligned_ids[token_index] in blank_ids:
+            token_index += 1
+        line_starts.append(token_index)
+    
+    if token_index < total:
+        line_starts.append(total)
+    
+    return line_starts
+
+CHUNK_BITS = 5
+
+def _content_chunks(keys):
+    """Cut a sequence of line keys into content-defined chunks of about 2**CHUNK_BITS lines.
+
+    A chunk ends after any line whose hashed key has its top CHUNK_BITS bits
+    clear, so boundaries depend only on nearby content and survive insertions.
+    """
+    chunks = []
+    start = 0
+    for index, key in enumerate(keys):
+        if ((key * 2654435761) & 0xFFFFFFFF) >> (32 - CHUNK_BITS) == 0:
+            chunks.append((start, index + 1))
+            start = index + 1
+    if start < len(keys):
+        chunks.append((start, len(keys)))
+    return chunks
+
+class ComparisonSession:
+    """Incremental comparison of one document against successive revisions of another.
+
+    Token ids, per-line hashes, the line matches and the word-level opcodes of
+    every changed line hunk are kept between calls to `compare`. When document
+    2 is revised, unchanged lines keep their previous matches, the line diff
+    only runs on the gaps around edited lines and only hunks whose lines
+    changed are diffed again at word level; everything else is spliced in.
+    
+    `normalize` names NORMALIZATIONS applied to the matching only: lines and
+    words are matched on their comparison keys, whitespace is left out of
+    matching when collapsed, and the aligned output keeps the original tokens.
+    """
+    
+    def __init__(self, doc1_tokens, backend=DEFAULT_DIFF_BACKEND, normalize=()):
+        if backend not in DIFF_BACKENDS:
+            raise ValueError(f"Unknown diff backend: {backend}")
+        self.backend = backend
+        self.normalize = parse_normalization(normalize)
+        self.collapse_whitespace = 'whitespace' in self.normalize
+        self.table = TokenTable(self.normalize)
+        self.line_ids = {}
+        self.doc1_ids, self.doc1_starts = self.table.intern_lines(doc1_tokens)
+        self.doc1_keys = [self._line_key(self.doc1_ids[self.doc1_starts[i]:self.doc1_starts[i + 1]])
+                          for i in range(len(self.doc1_starts) - 1)]
+        self.revisions = 0
+        self.reused_hunks = 0
+        self.diffed_hunks = 0
+        self._doc2_lines = {}
+        self._doc2_keys = None
+        self._line_blocks = None
+        self._hunk_opcodes = {}
+        self._lock = threading.Lock()
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def _line_key(self, line_token_ids):
+        """Return the integer id shared by all lines with the same tokens (or comparison keys)"""
+        return self.line_ids.setdefault(self._match_ids(line_token_ids).tobytes(), len(self.line_ids))
+    
+    def _match_ids(self, token_ids):
+        """Return the ids that token_ids are matched on: themselves, or their comparison keys"""
+        keys = self.table.keys
+        if keys is None:
+            return token_ids
+        if self.collapse_whitespace:
+            return array('i', [keys[token_id] for token_id in token_ids if keys[token_id]])
+        return array('i', [keys[token_id] for token_id in token_ids])
+    
+    def _word_positions(self, hunk_ids):
+        """Return the offsets of the tokens of a hunk that take part in matching when whitespace is collapsed"""
+        keys = self.table.keys
+        return [index for index, token_id in enumerate(hunk_ids) if keys[token_id]]
+    
+    def _intern_doc2(self, doc2_tokens):
+        """Intern a revision of document 2, reusing the ids of lines seen in the previous one"""
+        previous = self._doc2_lines
+        lines = {}
+        token_ids = array('i')
+        line_starts = array('i', [0])
+        keys = []
+        for line in doc2_tokens:
+            line_tokens = tuple(line)
+            entry = lines.get(line_tokens) or previous.get(line_tokens)
+            if entry is None:
+                line_token_ids = array('i', [self.table.intern(token) for token in line])
+                entry = (line_token_ids, self._line_key(line_token_ids))
+            lines[line_tokens] = entry
+            token_ids.extend(entry[0])
+            line_starts.append(len(token_ids))
+            keys.append(entry[1])
+        self._doc2_lines = lines
+        return token_ids, line_starts, keys
+    
+    def _carried_blocks(self, doc2_keys):
+        """Translate the previous line matches to positions in the new revision of document 2.
+
+        Both revisions are cut into content-defined chunks and the chunk hashes
+        are diffed; matches inside unchanged chunks are kept at their new positions.
+        """
+        old_keys = self._doc2_keys
+        old_chunks = _content_chunks(old_keys)
+        new_chunks = _content_chunks(doc2_keys)
+        chunk_ids = {}
+        old_ids = [chunk_ids.setdefault(tuple(old_keys[start:end]), len(chunk_ids)) for start, end in old_chunks]
+        new_ids = [chunk_ids.setdefault(tuple(doc2_keys[start:end]), len(chunk_ids)) for start, end in new_chunks]
+        
+        moves = [(old_chunks[i1][0], new_chunks[j1][0], old_chunks[i2 - 1][1] - old_chunks[i1][0])
+                 for tag, i1, i2, j1, j2 in patience_opcodes(old_ids, new_ids) if tag == 'equal']
+        
+        blocks = []
+        move = 0
+        for i, j, size in self._line_blocks:
+            while move < len(moves) and moves[move][0] + moves[move][2] <= j:
+                move += 1
+            for old_start, new_start, length in moves[move:]:
+                if old_start >= j + size:
+                    break
+                lo, hi = max(j, old_start), min(j + size, old_start + length)
+                if lo < hi:
+                    blocks.append((i + lo - j, new_start + lo - old_start, hi - lo))
+        return blocks
+    
+    def _line_opcodes(self, doc2_keys):
+        """Align the lines of both documents, reusing the previous alignment when there is one"""
+        doc1_keys = self.doc1_keys
+        if self._line_blocks is None:
+            return patience_opcodes(doc1_keys, doc2_keys)
+        
+        blocks = []
+        a = b = 0
+        for i, j, size in self._carried_blocks(doc2_keys) + [(len(doc1_keys), len(doc2_keys), 0)]:
+            if a < i and b < j:
+                blocks.extend((a + i1, b + j1, i2 - i1) for tag, i1, i2, j1, j2
+                              in patience_opcodes(doc1_keys[a:i], doc2_keys[b:j]) if tag == 'equal')
+            blocks.append((i, j, size))
+            a, b = i + size, j + size
+        return opcodes_from_blocks(blocks, len(doc1_keys), len(doc2_keys))
+    
+    def compare(self, doc2_tokens):
+        """Compare document 1 with this revision of document 2 and return (doc1_aligned, doc2_aligned)"""
+        with self._lock:
+            diff_tokens = DIFF_BACKENDS[self.backend]
+            doc1_ids, doc1_starts, doc1_keys = self.doc1_ids, self.doc1_starts, self.doc1_keys
+            doc2_ids, doc2_starts, doc2_keys = self._intern_doc2(doc2_tokens)
+            
+            aligned_doc1 = (array('i'), bytearray())
+            aligned_doc2 = (array('i'), bytearray())
+            previous_opcodes = self._hunk_opcodes
+            hunk_opcodes = {}
+            line_blocks = []
+            self.reused_hunks = self.diffed_hunks = 0
+            
+            for tag, i1, i2, j1, j2 in self._line_opcodes(doc2_keys):
+                hunk_doc1 = doc1_ids[doc1_starts[i1]:doc1_starts[i2]]
+                hunk_doc2 = doc2_ids[doc2_starts[j1]:doc2_starts[j2]]
+                
+                if tag == 'equal':
+                    line_blocks.append((i1, j1, i2 - i1))
+                    if not self.collapse_whitespace or hunk_doc1 == hunk_doc2:
+                        align_tokens(hunk_doc1, hunk_doc2, [('equal', 0, len(hunk_doc1), 0, len(hunk_doc2))],
+                                     aligned_doc1, aligned_doc2)
+                        continue
+                    words = sum(1 for token_id in hunk_doc1 if self.table.keys[token_id])
+                    opcodes = [('equal', 0, words, 0, words)]
+                else:
+                    hunk_key = (tuple(doc1_keys[i1:i2]), tuple(doc2_keys[j1:j2]))
+                    opcodes = previous_opcodes.get(hunk_key)
+                    if opcodes is None:
+                        opcodes = diff_tokens(self._match_ids(hunk_doc1), self._match_ids(hunk_doc2))
+                        self.diffed_hunks += 1
+                    else:
+                        self.reused_hunks += 1
+                    hunk_opcodes[hunk_key] = opcodes
+                
+                if self.collapse_whitespace:
+                    align_words(hunk_doc1, hunk_doc2, (self._word_positions(hunk_doc1), self._word_positions(hunk_doc2)),
+                                opcodes, aligned_doc1, aligned_doc2)
+                else:
+                    align_tokens(hunk_doc1, hunk_doc2, opcodes, aligned_doc1, aligned_doc2)
+            
+            self._hunk_opcodes = hunk_opcodes
+            self._line_blocks = line_blocks
+            self._doc2_keys = doc2_keys
+            self.revisions += 1
+            
+            metrics.inc('xsukax_comparisons_total')
+            metrics.inc('xsukax_tokens_compared_total', len(doc1_ids) + len(doc2_ids))
+            metrics.inc('xsukax_lines_compared_total', len(doc1_keys) + len(doc2_keys))
+            
+            doc1_aligned = AlignedLines(self.table, aligned_doc1[0], aligned_doc1[1],
+                                        reconstruct_lines(aligned_doc1[0], doc1_starts, self.table))
+            doc2_aligned = AlignedLines(self.table, aligned_doc2[0], aligned_doc2[1],
+                                        reconstruct_lines(aligned_doc2[0], doc2_starts, self.table))
+            return doc1_aligned, doc2_aligned
+
+def compare_documents(doc1_tokens, doc2_tokens, backend=DEFAULT_DIFF_BACKEND, normalize=()):
+    """Compare tokenized documents and return alignment information.
+
+    Lines are aligned first by their exact text using a patience diff, then
+    word-level matching runs only inside the line hunks that changed, so the
+    cost follows the amount of change rather than the document length.
+    `backend` names the entry of DIFF_BACKENDS used for the word-level pass.
+    Tokens are interned to integer ids, so matching and hashing run on ints
+    and the returned AlignedLines hold compact arrays instead of tuples.
+    `normalize` lists NORMALIZATIONS to ignore when matching.
+    """
+    return ComparisonSession(doc1_tokens, backend, normalize).compare(doc2_tokens)
+
+def _same_token_signatures(aligned_lines, signatures):
+    """Yield (aligned index, signature) of each `same` token; placeholders (id 0) carry no signature"""
+    position = 0
+    for index, (token_id, status) in enumerate(zip(aligned_lines.token_ids, aligned_lines.statuses)):
+        if token_id:
+            if status == STATUS_SAME:
+                yield index, signatures[position]
+            position += 1
+
+def mark_formatting_changes(doc1_aligned, doc2_aligned, doc1_signatures, doc2_signatures):
+    """Relabel aligned `same` tokens whose formatting signatures differ as STATUS_FORMATTED.
+
+    Equal tokens are emitted in the same order on both sides, so the n-th
+    `same` token of one document is the counterpart of the n-th of the other.
+    """
+    doc1_same = _same_token_signatures(doc1_aligned, doc1_signatures)
+    doc2_same = _same_token_signatures(doc2_aligned, doc2_signatures)
+    for (doc1_index, doc1_signature), (doc2_index, doc2_signature) in zip(doc1_same, doc2_same):
+        if doc1_signature != doc2_signature:
+            doc1_aligned.statuses[doc1_index] = STATUS_FORMATTED
+            doc2_aligned.statuses[doc2_index] = STATUS_FORMATTED
+
+def iter_html_lines(aligned_lines):
+    """Yield the HTML of each aligned line with its line number and colored tokens"""
+    for line_num, line_tokens in enumerate(aligned_lines, 1):
+        parts = [f'<div class="content-line"><span class="line-number">{line_num}</span><div class="line-content">']
+        
+        for token, status in line_tokens:
+            if token.strip():
+                escaped_token = token.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                parts.append(f'<span class="word {status}">{escaped_token}</span>')
+            else:
+                parts.append(token.replace(' ', '&nbsp;').replace('\t', '&nbsp;&nbsp;&nbsp;&nbsp;'))
+        
+        parts.append('</div></div>')
+        yield ''.join(parts)
+
+def generate_html_content(aligned_lines):
+    """Generate HTML content with line numbers and colored tokens"""
+    return ''.join(iter_html_lines(aligned_lines))
+
+def iter_html_blocks(aligned_lines, block_size=STREAM_BLOCK_LINES):
+    """Yield the rendered HTML in blocks of `block_size` lines"""
+    html_lines = iter_html_lines(aligned_lines)
+    while True:
+        block = ''.join(islice(html_lines, block_size))
+        if not block:
+            return
+        yield block
+
+def encode_runs(aligned_lines):
+    """Encode aligned lines as per-line token ids and flat (status, length) run pairs"""
+    token_ids = aligned_lines.token_ids
+    statuses = aligned_lines.statuses
+    line_starts = aligned_lines.line_starts
+    ids = []
+    runs = []
+    
+    for line in range(len(aligned_lines)):
+        start, end = line_starts[line], line_starts[line + 1]
+        ids.append(token_ids[start:end].tolist())
+        line_runs = []
+        for status, group in groupby(statuses[start:end]):
+            line_runs.append(status)
+            line_runs.append(sum(1 for _ in group))
+        runs.append(line_runs)
+    
+    return {'ids': ids, 'runs': runs}
+
+NON_WORD_FLAG = 8
+
+def as_aligned_lines(aligned_lines):
+    """Return `aligned_lines` as AlignedLines, interning plain lists of (token, status) lines"""
+    if isinstance(aligned_lines, AlignedLines):
+        return aligned_lines
+    
+    table = TokenTable()
+    token_ids = array('i')
+    statuses = bytearray()
+    line_starts = array('i', [0])
+    for line in aligned_lines:
+        token_ids.extend([table.intern(token) for token, _ in line])
+        statuses.extend([STATUS_NAMES.index(status) for _, status in line])
+        line_starts.append(len(token_ids))
+    return AlignedLines(table, token_ids, statuses, line_starts)
+
+def word_statuses(aligned_lines):
+    """Return one byte per aligned token: its status code, with NON_WORD_FLAG set for whitespace.
+
+    Each vocabulary entry is stripped once, so later passes only compare bytes.
+    """
+    flags = bytes(0 if token.strip() else NON_WORD_FLAG for token in aligned_lines.table.tokens)
+    return bytes(map(or_, aligned_lines.statuses, map(flags.__getitem__, aligned_lines.token_ids)))
+
+def summarize_alignment(doc1_aligned, doc2_aligned):
+    """Compute the analytics and the per-line classification in one pass.
+
+    Returns (analytics, line_differences) as produced by calculate_analytics
+    and analyze_line_differences.
+    """
+    doc1_aligned = as_aligned_lines(doc1_aligned)
+    doc2_aligned = as_aligned_lines(doc2_aligned)
+    doc1_words = word_statuses(doc1_aligned)
+    doc2_words = word_statuses(doc2_aligned)
+    
+    total_words_doc1 = sum(doc1_words.count(status) for status in range(len(STATUS_NAMES)))
+    total_words_doc2 = sum(doc2_words.count(status) for status in range(len(STATUS_NAMES)))
+    formatted_words = doc1_words.count(STATUS_FORMATTED)
+    same_words = doc1_words.count(STATUS_SAME) + formatted_words
+    total_words = max(total_words_doc1, total_words_doc2)
+    
+    analytics = {
+        'total_words': total_words,
+        'added_words': doc2_words.count(STATUS_ADDED),
+        'removed_words': doc1_words.count(STATUS_MISSING),
+        'modified_words': doc1_words.count(STATUS_DIFFERENT),
+        'formatted_words': formatted_words,
+        'similarity': round((same_words / total_words * 100) if total_words > 0 else 100, 1)
+    }
+    
+    added_lines = []
+    removed_lines = []
+    modified_lines = []
+    formatted_lines = []
+    doc1_starts = doc1_aligned.line_starts
+    doc2_starts = doc2_aligned.line_starts
+    doc1_lines = len(doc1_aligned)
+    doc2_lines = len(doc2_aligned)
+    
+    for line_num in range(max(doc1_lines, doc2_lines)):
+        doc1_line = doc1_words[doc1_starts[line_num]:doc1_starts[line_num + 1]] if line_num < doc1_lines else b''
+        doc2_line = doc2_words[doc2_starts[line_num]:doc2_starts[line_num + 1]] if line_num < doc2_lines else b''
+        
+        doc1_has_missing = STATUS_MISSING in doc1_line
+        doc1_has_different = STATUS_DIFFERENT in doc1_line
+        doc2_has_added = STATUS_ADDED in doc2_line
+        
+        if doc1_has_missing and doc2_has_added:
+            if not doc1_has_different:
+                removed_lines.append(line_num + 1)
+                added_lines.append(line_num + 1)
+            else:
+                modified_lines.append(line_num + 1)
+        elif doc1_has_missing or doc1_has_different or doc2_has_added or STATUS_DIFFERENT in doc2_line:
+            modified_lines.append(line_num + 1)
+        elif STATUS_FORMATTED in doc1_line or STATUS_FORMATTED in doc2_line:
+            formatted_lines.append(line_num + 1)
+    
+    line_differences = {
+        'added': added_lines,
+        'removed': removed_lines,
+        'modified': modified_lines,
+        'formatted': formatted_lines
+    }
+    return analytics, line_differences
+
+def changed_word_positions(doc1_aligned, doc2_aligned):
+    """Return, for each document, the offsets in its original tokens of its changed words.
+
+    Outside `different` runs both sides emit tokens in lockstep: equal tokens
+    pair up, deletions face placeholders and placeholders face insertions,
+    which tells document 1's deleted tokens from its placeholders. Whitespace
+    changes are left out, as in summarize_alignment. Alignments whose
+    whitespace was collapsed do not keep this lockstep.
+    """
+    doc1_words = word_statuses(doc1_aligned)
+    doc2_words = word_statuses(doc2_aligned)
+    doc2_paired = bytes(status for status in doc2_aligned.statuses if status != STATUS_DIFFERENT)
+    doc1_positions = []
+    doc2_positions = []
+    
+    offset = paired = 0
+    for status, word in zip(doc1_aligned.statuses, doc1_words):
+        if status != STATUS_DIFFERENT:
+            paired += 1
+            if status == STATUS_MISSING and doc2_paired[paired - 1] == STATUS_ADDED:
+                continue
+        if word == STATUS_DIFFERENT or word == STATUS_MISSING:
+            doc1_positions.append(offset)
+        offset += 1
+    
+    offset = 0
+    for status, word in zip(doc2_aligned.statuses, doc2_words):
+        if status == STATUS_MISSING:
+            continue
+        if word == STATUS_DIFFERENT or word == STATUS_ADDED:
+            doc2_positions.append(offset)
+        offset += 1
+    
+    return doc1_positions, doc2_positions
+
+def analyze_line_differences(doc1_aligned, doc2_aligned):
+    """Analyze which lines contain differences"""
+    return summarize_alignment(doc1_aligned, doc2_aligned)[1]
+
+def calculate_analytics(doc1_aligned, doc2_aligned):
+    """Calculate detailed comparison analytics"""
+    return summarize_alignment(doc1_aligned, doc2_aligned)[0]
+
+REFINE_LEVELS = ('char', 'sentence')
+REFINE_MAX_CHARS = 4000
+SENTENCE_PATTERN = re.compile(r'[^.!?؟\n]+[.!?؟]*\s*|[.!?؟]+\s*|\n')
+REFINE_STATUSES = {
+    'equal': ('same', 'same'),
+    'replace': ('different', 'different'),
+    'delete': ('missing', 'missing'),
+    'insert': ('added', 'added')
+}
+
+class AlignedHunks:
+    """Locates the changed hunks of an alignment without running the diff again.
+
+    Unchanged (`same` or `formatted`) tokens are emitted in the same order on
+    both sides, so hunk n is everything between the n-th and (n+1)-th
+    unchanged token of each document.
+    """
+    
+    def __init__(self, doc1_aligned, doc2_aligned):
+        self.sides = (doc1_aligned, doc2_aligned)
+        self.anchors = tuple(
+            array('i', [index for index, status in enumerate(aligned.statuses)
+                        if status == STATUS_SAME or status == STATUS_FORMATTED])
+            for aligned in self.sides
+        )
+    
+    def span(self, side, hunk):
+        """Return the [start, end) aligned token range of `hunk` in document `side` (0 or 1)"""
+        anchors = self.anchors[side]
+        start = anchors[hunk - 1] + 1 if hunk > 0 else 0
+        end = anchors[hunk] if hunk < len(anchors) else len(self.sides[side].statuses)
+        return start, end
+    
+    def on_line(self, line):
+        """Return the hunks touching the 0-based aligned `line` of either document"""
+        hunks = set()
+        for side, aligned in enumerate(self.sides):
+            if line >= len(aligned):
+                continue
+            start, end = aligned.line_starts[line], aligned.line_starts[line + 1]
+            anchors = self.anchors[side]
+            for hunk in range(bisect_left(anchors, start), bisect_left(anchors, end) + 1):
+                hunk_start, hunk_end = self.span(side, hunk)
+                if hunk_start < hunk_end and hunk_start < end and hunk_end > start:
+                    hunks.add(hunk)
+        return sorted(hunks)
+    
+    def text(self, side, hunk):
+        """Return the text of `hunk` in document `side` and its 1-based [first, last] line range.
+
+        Placeholders (id 0) standing in for the other side's insertions or
+        deletions are skipped; a hunk with no text of its own has no lines.
+        """
+        aligned = self.sides[side]
+        start, end = self.span(side, hunk)
+        tokens = aligned.table.tokens
+        line_starts = aligned.line_starts
+        lines = []
+        line_numbers = []
+        for line in range(bisect_right(line_starts, start) - 1, bisect_right(line_starts, end - 1)):
+            token_ids = aligned.token_ids[max(line_starts[line], start):min(line_starts[line + 1], end)]
+            if any(token_ids):
+                lines.append(''.join(tokens[token_id] for token_id in token_ids))
+                line_numbers.append(line + 1)
+        
+        if not lines:
+            return '', None
+        return '\n'.join(lines), [line_numbers[0], line_numbers[-1]]
+    
+    def _widen(self, side, hunk):
+        """Count the unchanged tokens before and after `hunk` that complete its sentences in document `side`.
+
+        Returns None when the hunk has no text of its own on this side.
+        """
+        aligned = self.sides[side]
+        token_ids = aligned.token_ids
+        start, end = self.span(side, hunk)
+        own = [index for index in range(start, end) if token_ids[index]]
+        if not own:
+            return None
+        
+        tokens = aligned.table.tokens
+        line_starts = aligned.line_starts
+        first_line = bisect_right(line_starts, own[0]) - 1
+        last_line = bisect_right(line_starts, own[-1]) - 1
+        lo = line_starts[first_line]
+        parts = []
+        offsets = []
+        length = 0
+        for line in range(first_line, last_line + 1):
+            if line > first_line:
+                parts.append('\n')
+                length += 1
+            for index in range(line_starts[line], line_starts[line + 1]):
+                offsets.append(length)
+                parts.append(tokens[token_ids[index]])
+                length += len(parts[-1])
+        offsets.append(length)
+        
+        text_start, text_end = offsets[own[0] - lo], offsets[own[-1] + 1 - lo]
+        sentence_start, sentence_end = text_start, text_end
+        for match in SENTENCE_PATTERN.finditer(''.join(parts)):
+            if match.start() < text_end and match.end() > text_start:
+                sentence_start = min(sentence_start, match.start())
+                sentence_end = max(sentence_end, match.end())
+        
+        anchors = self.anchors[side]
+        first = lo + bisect_left(offsets, sentence_start)
+        last = lo + bisect_left(offsets, sentence_end)
+        return (bisect_left(anchors, start) - bisect_left(anchors, first),
+                bisect_left(anchors, last) - bisect_left(anchors, end))
+    
+    def _units(self, side, hunk, before, after):
+        """Split the text of `hunk` plus `before`/`after` unchanged tokens of document `side` into sentences"""
+        aligned = self.sides[side]
+        anchors = self.anchors[side]
+        start, end = self.span(side, hunk)
+        lo = anchors[hunk - before] if before else start
+        hi = anchors[hunk + after - 1] + 1 if after else end
+        
+        token_ids = aligned.token_ids
+        tokens = aligned.table.tokens
+        line_starts = aligned.line_starts
+        parts = []
+        lines = []
+        for line in range(bisect_right(line_starts, lo) - 1, bisect_left(line_starts, hi)):
+            line_ids = [token_id for token_id in token_ids[max(line_starts[line], lo):min(line_starts[line + 1], hi)]
+                        if token_id]
+            if line_ids:
+                if lines:
+                    parts.append('\n')
+                parts.extend(tokens[token_id] for token_id in line_ids)
+                lines.append(line)
+        
+        units = SENTENCE_PATTERN.findall(''.join(parts))
+        if not ''.join(units).strip():
+            return [], None
+        return units, [lines[0] + 1, lines[-1] + 1]
+    
+    def sentences(self, hunk):
+        """Return the whole sentences around `hunk` in both documents, as ((units, lines), (units, lines)).
+
+        On each side with text of its own, the hunk is widened to the
+        sentences it overlaps on its lines; the other side is widened over the
+        same unchanged tokens, so both documents show the same context.
+        `lines` is the 1-based [first, last] line range, or None without text.
+        """
+        before = after = 0
+        for side in (0, 1):
+            widened = self._widen(side, hunk)
+            if widened is not None:
+                before, after = max(before, widened[0]), max(after, widened[1])
+        return self._units(0, hunk, before, after), self._units(1, hunk, before, after)
+
+def diff_segments(doc1_units, doc2_units):
+    """Diff two sequences of text units into per-document lists of [status, text] segments"""
+    doc1_segments = []
+    doc2_segments = []
+    matcher = SequenceMatcher(None, doc1_units, doc2_units, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        for segments, status, units in ((doc1_segments, REFINE_STATUSES[tag][0], doc1_units[i1:i2]),
+                                        (doc2_segments, REFINE_STATUSES[tag][1], doc2_units[j1:j2])):
+            text = ''.join(units)
+            if not text:
+                continue
+            if segments and segments[-1][0] == status:
+                segments[-1][1] += text
+            else:
+                segments.append([status, text])
+    return doc1_segments, doc2_segments
+
+def refine_line(hunks, line, level='char'):
+    """Diff the hunks touching 1-based `line` character by character or sentence by sentence.
+
+    Character level falls back to sentences for hunks longer than
+    REFINE_MAX_CHARS; each refined hunk reports the level actually used.
+    Sentence level diffs the whole sentences around each hunk, reported once
+    when several hunks fall in the same sentences.
+    Hunks that only change whitespace are skipped, as in line_differences.
+    """
+    if level not in REFINE_LEVELS:
+        raise ValueError(f'Unknown refinement level: {level}')
+    
+    refined = []
+    previous_units = None
+    for hunk in hunks.on_line(line - 1):
+        doc1_text, doc1_lines = hunks.text(0, hunk)
+        doc2_text, doc2_lines = hunks.text(1, hunk)
+        if not doc1_text.strip() and not doc2_text.strip():
+            continue
+        
+        hunk_level = level
+        if level == 'char' and len(doc1_text) + len(doc2_text) > REFINE_MAX_CHARS:
+            hunk_level = 'sentence'
+        if hunk_level == 'char':
+            doc1_segments, doc2_segments = diff_segments(doc1_text, doc2_text)
+        else:
+            (doc1_units, doc1_lines), (doc2_units, doc2_lines) = hunks.sentences(hunk)
+            if (doc1_units, doc2_units) == previous_units:
+                continue
+            previous_units = (doc1_units, doc2_units)
+            doc1_segments, doc2_segments = diff_segments(doc1_units, doc2_units)
+        
+        refined.append({
+            'hunk': hunk,
+            'level': hunk_level,
+            'doc1': {'lines': doc1_lines, 'segments': doc1_segments},
+            'doc2': {'lines': doc2_lines, 'segments': doc2_segments}
+        })
+    return refined
+
+def aligned_from_runs(tokens, encoded):
+    """Rebuild AlignedLines from the token list and the ids/runs produced by encode_runs"""
+    table = TokenTable()
+    table.tokens = tokens
+    table.ids = {token: token_id for token_id, token in enumerate(tokens)}
+    token_ids = array('i')
+    statuses = bytearray()
+    line_starts = array('i', [0])
+    for line_ids, line_runs in zip(encoded['ids'], encoded['runs']):
+        token_ids.extend(line_ids)
+        for r in range(0, len(line_runs), 2):
+            statuses.extend(bytes((line_runs[r],)) * line_runs[r + 1])
+        line_starts.append(len(token_ids))
+    return AlignedLines(table, token_ids, statuses, line_starts)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+METRIC_HELP = {
+    'xsukax_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'xsukax_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint'),
+    'xsukax_request_bytes': ('histogram', 'Uploaded request body size by endpoint'),
+    'xsukax_response_bytes': ('histogram', 'Response payload size by endpoint'),
+    'xsukax_stage_duration_seconds': ('histogram', 'Time spent in each comparison pipeline stage'),
+    'xsukax_comparisons_total': ('counter', 'Document comparisons run by the diff engine'),
+    'xsukax_tokens_compared_total': ('counter', 'Tokens of both documents passed to the diff engine'),
+    'xsukax_lines_compared_total': ('counter', 'Lines of both documents passed to the diff engine'),
+    'xsukax_profiles_written_total': ('counter', 'Slow requests whose cProfile data was written'),
+    'xsukax_profile_errors_total': ('counter', 'Slow-request profiles that could not be written'),
+    'xsukax_limit_rejections_total': ('counter', 'Comparisons rejected by the word or CPU-time limits'),
+}
+
+def _label_text(labels):
+    """Format (name, value) label pairs as a Prometheus label set"""
+    if not labels:
+        return ''
+    pairs = (f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels)
+    return '{' + ','.join(pairs) + '}'
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format"""
+    
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                     'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+    
+    def take_counters(self):
+        """Return the counters as ((name, labels), value) pairs and reset them, to hand them to another process"""
+        with self._lock:
+            counters, self._counters = list(self._counters.items()), {}
+        return counters
+    
+    def add_counters(self, counters):
+        """Add counters returned by take_counters in another process"""
+        with self._lock:
+            for key, value in counters:
+                self._counters[key] = self._counters.get(key, 0) + value
+    
+    def render(self, extra=()):
+        """Return all metrics as Prometheus text, plus `extra` (name, type, help, labels, value) samples"""
+        lines = []
+        
+        def header(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+        
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(value, counts=list(value['counts'])))
+                                for key, value in self._histograms.items())
+        
+        for name, group in groupby(counters, key=lambda item: item[0][0]):
+            header(name, *METRIC_HELP[name])
+            for (_, labels), value in group:
+                lines.append(f'{name}{_label_text(labels)} {value}')
+        
+        for name, group in groupby(histograms, key=lambda item: item[0][0]):
+            header(name, *METRIC_HELP[name])
+            for (_, labels), histogram in group:
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    lines.append(f'{name}_bucket{_label_text(labels + (("le", format(bound, "g")),))} {count}')
+                lines.append(f'{name}_bucket{_label_text(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                lines.append(f'{name}_sum{_label_text(labels)} {histogram["sum"]:.6f}')
+                lines.append(f'{name}_count{_label_text(labels)} {histogram["count"]}')
+        
+        for name, group in groupby(sorted(extra, key=lambda sample: sample[0]), key=lambda sample: sample[0]):
+            group = list(group)
+            header(name, group[0][1], group[0][2])
+            for _, _, _, labels, value in group:
+                lines.append(f'{name}{_label_text(tuple(sorted(labels.items())))} {value}')
+        
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Stage timings of the request being handled by the current thread, for Server-Timing
+_request_state = threading.local()
+
+class StageTimer:
+    """Progress callback that measures how long each pipeline stage takes.
+
+    Calling the timer with a stage name closes the running stage and starts the
+    new one, then forwards the name to `progress`. Repeated stages accumulate.
+    """
+    
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.timings = {}
+        self._stage = None
+        self._started = None
+    
+    def __call__(self, stage):
+        self._close()
+        if self.progress is not None:
+            self.progress(stage)
+        self._stage = stage
+        self._started = time.perf_counter()
+    
+    def _close(self):
+        if self._stage is not None:
+            elapsed = (time.perf_counter() - self._started) * 1000
+            self.timings[self._stage] = self.timings.get(self._stage, 0) + elapsed
+            self._stage = None
+    
+    def record(self, timings):
+        """Add stage timings measured elsewhere, such as in a pool worker.
+
+        The running stage is shortened by the same amount so the time is not counted twice.
+        """
+        for stage, elapsed in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0) + elapsed
+        if self._stage is not None:
+            self._started += sum(timings.values()) / 1000
+    
+    def finish(self):
+        """Close the running stage and return the timings in milliseconds.
+
+        The timings are also recorded in `metrics` and, when called while
+        handling a request, reported in that request's Server-Timing header.
+        """
+        self._close()
+        request_timings = getattr(_request_state, 'timings', None)
+        for stage, elapsed in self.timings.items():
+            metrics.observe('xsukax_stage_duration_seconds', elapsed / 1000, stage=stage)
+            if request_timings is not None:
+                request_timings[stage] = request_timings.get(stage, 0) + elapsed
+        return {stage: round(elapsed, 2) for stage, elapsed in self.timings.items()}
+
+def _blocks_digest(blocks):
+    return hashlib.sha256(json.dumps(blocks, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _section_lines(blocks):
+    """Tokenize the blocks of a section, returning the lines and the block index of each line"""
+    lines = []
+    line_blocks = []
+    for index, block in enumerate(blocks):
+        block_lines = tokenize_text(block['text'])
+        lines.extend(block_lines)
+        line_blocks.extend([index] * len(block_lines))
+    return lines, line_blocks
+
+def _compare_section(doc1_name, doc1_blocks, doc2_name, doc2_blocks, backend):
+    """Compare one pair of sections, returning its result entry and its unchanged word count.
+
+    Sections whose blocks hash identically are reported without running a diff.
+    """
+    entry = {'name': doc2_name or doc1_name, 'doc1_section': doc1_name, 'doc2_section': doc2_name}
+    
+    if doc1_blocks is not None and doc2_blocks is not None and _blocks_digest(doc1_blocks) == _blocks_digest(doc2_blocks):
+        words = sum(len(block['text'].split()) for block in doc1_blocks)
+        entry.update(status='unchanged', changed_blocks=[],
+                     analytics={'total_words': words, 'added_words': 0, 'removed_words': 0,
+                                'modified_words': 0, 'formatted_words': 0, 'similarity': 100.0},
+                     line_differences={'added': [], 'removed': [], 'modified': [], 'formatted': []})
+        return entry, words
+    
+    doc1_lines, doc1_line_blocks = _section_lines(doc1_blocks or [])
+    doc2_lines, doc2_line_blocks = _section_lines(doc2_blocks or [])
+    doc1_aligned, doc2_aligned = compare_documents(doc1_lines, doc2_lines, backend)
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    changed_positions = changed_word_positions(doc1_aligned, doc2_aligned)
+    
+    changed_blocks = []
+    seen = set()
+    for document, (blocks, lines, line_blocks, positions) in enumerate(
+            ((doc1_blocks, doc1_lines, doc1_line_blocks, changed_positions[0]),
+             (doc2_blocks, doc2_lines, doc2_line_blocks, changed_positions[1])), 1):
+        line_ends = list(accumulate(map(len, lines)))
+        for position in positions:
+            index = line_blocks[bisect_right(line_ends, position)]
+            if (document, index) not in seen:
+                seen.add((document, index))
+                block = {key: value for key, value in blocks[index].items() if key != 'text'}
+                block['document'] = document
+                changed_blocks.append(block)
+    
+    if doc1_blocks is None:
+        status = 'added'
+    elif doc2_blocks is None:
+        status = 'removed'
+    else:
+        status = 'changed'
+    
+    entry.update(status=status, analytics=analytics, line_differences=line_differences,
+                 changed_blocks=changed_blocks)
+    return entry, word_statuses(doc1_aligned).count(STATUS_SAME)
+
+SECTION_PAIR_THRESHOLD = 0.5
+
+def _pair_similar_sections(doc1_sections, doc2_sections):
+    """Pair sections of a changed run in order, matching each with its most similar counterpart.
+
+    Similarity is difflib's quick_ratio over the section words; sections
+    without a counterpart above SECTION_PAIR_THRESHOLD are paired with None.
+    """
+    doc2_words = [[word for block in blocks for word in block['text'].split()] for _, blocks in doc2_sections]
+    pairs = []
+    next_doc2 = 0
+    
+    for doc1_section in doc1_sections:
+        matcher = SequenceMatcher(None, autojunk=False)
+        matcher.set_seq2([word for block in doc1_section[1] for word in block['text'].split()])
+        best, best_ratio = None, SECTION_PAIR_THRESHOLD
+        for index in range(next_doc2, len(doc2_sections)):
+            matcher.set_seq1(doc2_words[index])
+            ratio = matcher.quick_ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = index, ratio
+        
+        if best is None:
+            pairs.append((doc1_section, None))
+            continue
+        pairs.extend((None, doc2_section) for doc2_section in doc2_sections[next_doc2:best])
+        pairs.append((doc1_section, doc2_sections[best]))
+        next_doc2 = best + 1
+    
+    pairs.extend((None, doc2_section) for doc2_section in doc2_sections[next_doc2:])
+    return pairs
+
+def compare_sections(doc1_sections, doc2_sections, backend=DEFAULT_DIFF_BACKEND):
+    """Diff two documents section by section, as extracted by extract_docx_sections.
+
+    Named sections are paired by name. Tables are paired by aligning the
+    sequence of table hashes, so inserting or editing one table leaves the
+    others matched. Returns aggregate analytics and the per-section results.
+    """
+    doc1_tables = [section for section in doc1_sections if section[0].startswith('table-')]
+    doc2_tables = [section for section in doc2_sections if section[0].startswith('table-')]
+    doc2_named = {name: blocks for name, blocks in doc2_sections if not name.startswith('table-')}
+    
+    pairs = []
+    for name, blocks in doc1_sections:
+        if name.startswith('table-'):
+            continue
+        pairs.append((name, blocks, name, doc2_named.get(name, [])))
+        if name != 'body':
+            continue
+        
+        table_ids = {}
+        doc1_keys = [table_ids.setdefault(_blocks_digest(blocks), len(table_ids)) for _, blocks in doc1_tables]
+        doc2_keys = [table_ids.setdefault(_blocks_digest(blocks), len(table_ids)) for _, blocks in doc2_tables]
+        for tag, i1, i2, j1, j2 in patience_opcodes(doc1_keys, doc2_keys):
+            for doc1_table, doc2_table in _pair_similar_sections(doc1_tables[i1:i2], doc2_tables[j1:j2]):
+                doc1_table = doc1_table or (None, None)
+                doc2_table = doc2_table or (None, None)
+                pairs.append((doc1_table[0], doc1_table[1], doc2_table[0], doc2_table[1]))
+    
+    sections = []
+    totals = {'total_words': 0, 'added_words': 0, 'removed_words': 0, 'modified_words': 0, 'formatted_words': 0}
+    same_words = 0
+    for doc1_name, doc1_blocks, doc2_name, doc2_blocks in pairs:
+        entry, section_same = _compare_section(doc1_name, doc1_blocks, doc2_name, doc2_blocks, backend)
+        sections.append(entry)
+        same_words += section_same
+        for field in totals:
+            totals[field] += entry['analytics'][field]
+    
+    total_words = totals['total_words']
+    totals['similarity'] = round((same_words / total_words * 100) if total_words > 0 else 100, 1)
+    return totals, sections
+
+@route('/')
+def index():
+    """Main page"""
+    from flask import render_template_string
+    return render_template_string(HTML_TEMPLATE)
+
+def comparison_key(doc1_digest, doc2_digest, options):
+    """Derive the result cache key (also used as ETag) for a document pair and options.
+
+    The configured extractor is part of the key since it changes the extracted text.
+    """
+    material = json.dumps([doc1_digest, doc2_digest, dict(options, extractor=DEFAULT_EXTRACTOR)], sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def align_pair(doc1_tokens, doc2_tokens, backend=DEFAULT_DIFF_BACKEND, signatures=None, normalize=()):
+    """Diff two tokenized documents and mark formatting changes, returning (doc1_aligned, doc2_aligned)"""
+    doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens, backend, normalize)
+    if signatures is not None:
+        mark_formatting_changes(doc1_aligned, doc2_aligned, *signatures)
+    return doc1_aligned, doc2_aligned
+
+def run_comparison(doc1_tokens, doc2_tokens, backend=DEFAULT_DIFF_BACKEND, progress=_no_progress, signatures=None,
+                   normalize=()):
+    """Run the full comparison pipeline and return the JSON payload fields.
+
+    `signatures` is an optional (doc1, doc2) pair of per-token formatting
+    signatures; when given, formatting-only changes are reported as well.
+    `normalize` lists NORMALIZATIONS ignored by the matching.
+    """
+    progress('diff')
+    doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens, backend, normalize)
+    if signatures is not None:
+        mark_formatting_changes(doc1_aligned, doc2_aligned, *signatures)
+    
+    progress('render')
+    doc1_html = generate_html_content(doc1_aligned)
+    doc2_html = generate_html_content(doc2_aligned)
+    
+    progress('analytics')
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    
+    return {
+        'doc1_html': doc1_html,
+        'doc2_html': doc2_html,
+        'analytics': analytics,
+        'line_differences': line_differences
+    }
+
+def run_compact_comparison(doc1_tokens, doc2_tokens, backend=DEFAULT_DIFF_BACKEND, progress=_no_progress, signatures=None,
+                           normalize=()):
+    """Run the comparison and return the compact payload fields rendered by the page"""
+    progress('diff')
+    doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens, backend, normalize)
+    if signatures is not None:
+        mark_formatting_changes(doc1_aligned, doc2_aligned, *signatures)
+    
+    progress('render')
+    doc1_runs = encode_runs(doc1_aligned)
+    doc2_runs = encode_runs(doc2_aligned)
+    
+    progress('analytics')
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    
+    return {
+        'statuses': list(STATUS_NAMES),
+        'tokens': doc1_aligned.table.tokens,
+        'doc1': doc1_runs,
+        'doc2': doc2_runs,
+        'analytics': analytics,
+        'line_differences': line_differences
+    }
+
+def load_pair(doc1_stream, doc2_stream, formatting=False, progress=_no_progress):
+    """Load both documents, returning (doc1_digest, doc1_tokens, doc2_digest, doc2_tokens, signatures).
+
+    `signatures` is None unless `formatting` is set, in which case the
+    documents are extracted run by run with load_document_formatting.
+    """
+    if not formatting:
+        doc1_digest, _, doc1_tokens = load_document(doc1_stream, progress)
+        doc2_digest, _, doc2_tokens = load_document(doc2_stream, progress)
+        return doc1_digest, doc1_tokens, doc2_digest, doc2_tokens, None
+    
+    doc1_digest, _, doc1_tokens, doc1_signatures = load_document_formatting(doc1_stream, progress)
+    doc2_digest, _, doc2_tokens, doc2_signatures = load_document_formatting(doc2_stream, progress)
+    return doc1_digest, doc1_tokens, doc2_digest, doc2_tokens, (doc1_signatures, doc2_signatures)
+
+def _init_comparison_worker():
+    # Forked workers inherit the parent's counters; drop them so tasks only report their own increments
+    metrics.take_counters()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _cpu_limit_exceeded)
+
+def _cpu_limit_exceeded(signum, frame):
+    raise LimitExceeded('Comparison exceeded the CPU time limit')
+
+def _limited_call(cpu_seconds, func, *args):
+    """Pool task: call func(*args) under a CPU-time limit.
+
+    Returns the result with the counters the call incremented in this worker,
+    which would otherwise never reach the serving process's metrics.
+    """
+    limits = None
+    if cpu_seconds and resource is not None:
+        limits = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = math.ceil(time.process_time() + cpu_seconds)
+        if limits[1] != resource.RLIM_INFINITY:
+            soft = min(soft, limits[1])
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, limits[1]))
+    
+    try:
+        return func(*args), metrics.take_counters()
+    finally:
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, limits)
+
+def _pooled_comparison(compact, doc1_tokens, doc2_tokens, backend, signatures, normalize):
+    """Pool task: run the comparison, returning (payload, timings)"""
+    timer = StageTimer()
+    run = run_compact_comparison if compact else run_comparison
+    payload = run(doc1_tokens, doc2_tokens, backend, timer, signatures, normalize)
+    return payload, timer.finish()
+
+class ComparisonPool:
+    """Process pool running the diff, render and analytics stages away from the request threads.
+
+    Each task is limited to `cpu_seconds` of CPU time (0 for no limit),
+    enforced with RLIMIT_CPU in the worker. Where that is unavailable (Windows)
+    the request stops waiting after the same number of wall-clock seconds.
+    """
+    
+    def __init__(self, workers=None, cpu_seconds=0):
+        self.workers = workers or os.cpu_count() or 1
+        self.cpu_seconds = cpu_seconds
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_comparison_worker)
+    
+    def call(self, func, *args):
+        """Run func(*args) in a worker under the CPU limit and return its result.
+
+        `func` and its arguments must be picklable. Counters the call
+        increments in the worker are added to `metrics`.
+        """
+        return self._result(self._executor.submit(_limited_call, self.cpu_seconds, func, *args))
+    
+    def map(self, func, *iterables):
+        """Like call for each tuple of arguments, spread across the workers; returns the results in order"""
+        futures = [self._executor.submit(_limited_call, self.cpu_seconds, func, *args) for args in zip(*iterables)]
+        try:
+            return [self._result(future) for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+    
+    def _result(self, future):
+        timeout = self.cpu_seconds if self.cpu_seconds and resource is None else None
+        try:
+            result, counters = future.result(timeout=timeout)
+        except (LimitExceeded, FutureTimeoutError):
+            future.cancel()
+            metrics.inc('xsukax_limit_rejections_total', limit='cpu')
+            raise LimitExceeded(f'Comparison exceeded the CPU time limit of {self.cpu_seconds:g}s')
+        
+        metrics.add_counters(counters)
+        return result
+    
+    def run(self, compact, doc1_tokens, doc2_tokens, backend, timer, signatures=None, normalize=()):
+        """Compare in a worker and return the payload, adding the worker's stage timings to `timer`"""
+        timer('diff')
+        payload, timings = self.call(_pooled_comparison, compact, doc1_tokens, doc2_tokens,
+                                     backend, signatures, normalize)
+        timer.record(timings)
+        return payload
+    
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+# Set by `serve --production`; None runs comparisons on the request thread
+comparison_pool = None
+
+def comparison_options(backend, formatting=False, normalize=(), **options):
+    """Build the option dict hashed into the result cache key"""
+    options['backend'] = backend
+    if formatting:
+        options['formatting'] = True
+    if normalize:
+        options['normalize'] = list(normalize)
+    return options
+
+def resolve_comparison(doc1_stream, doc2_stream, doc1_name, doc2_name, backend, compact=False,
+                       progress=_no_progress, formatting=False, normalize=()):
+    """Load both documents and return (key, payload), reusing the result cache when possible.
+
+    Freshly computed payloads carry per-stage `timings` in milliseconds.
+    """
+    timer = StageTimer(progress)
+    doc1_digest, doc1_tokens, doc2_digest, doc2_tokens, signatures = load_pair(doc1_stream, doc2_stream,
+                                                                               formatting, timer)
+    
+    if compact:
+        options = comparison_options(backend, formatting, normalize, format='compact')
+    else:
+        options = comparison_options(backend, formatting, normalize)
+    key = comparison_key(doc1_digest, doc2_digest, options)
+    payload = result_cache.get(key)
+    
+    if payload is None:
+        if comparison_pool is not None:
+            payload = comparison_pool.run(compact, doc1_tokens, doc2_tokens, backend, timer, signatures, normalize)
+        else:
+            run = run_compact_comparison if compact else run_comparison
+            payload = run(doc1_tokens, doc2_tokens, backend, timer, signatures, normalize)
+        payload.update(success=True, doc1_name=doc1_name, doc2_name=doc2_name, timings=timer.finish())
+        if compact:
+            payload['etag'] = key
+        result_cache.put(key, payload)
+    else:
+        timer.finish()
+        payload = dict(payload, doc1_name=doc1_name, doc2_name=doc2_name)
+    
+    return key, payload
+
+def _stream_events(start, doc1_aligned, doc2_aligned):
+    """Yield the `start` event, then the HTML line blocks of both documents interleaved so the panels fill together"""
+    yield json.dumps(dict(start, type='start')) + '\n'
+    for doc1_block, doc2_block in zip_longest(iter_html_blocks(doc1_aligned), iter_html_blocks(doc2_aligned)):
+        if doc1_block:
+            yield json.dumps({'type': 'lines', 'doc': 1, 'html': doc1_block}) + '\n'
+        if doc2_block:
+            yield json.dumps({'type': 'lines', 'doc': 2, 'html': doc2_block}) + '\n'
+    yield json.dumps({'type': 'end'}) + '\n'
+
+def stream_comparison(key, doc1_tokens, doc2_tokens, backend, doc1_name, doc2_name, signatures=None, normalize=()):
+    """Yield a comparison as NDJSON events: analytics first, then HTML line blocks.
+
+    `key` is the compact result key. Rendered blocks are not kept: the
+    alignment is stored in the result cache in the compact form of
+    run_compact_comparison, from which stream_cached renders later hits.
+    """
+    try:
+        timer = StageTimer()
+        timer('diff')
+        if comparison_pool is not None:
+            doc1_aligned, doc2_aligned = comparison_pool.call(align_pair, doc1_tokens, doc2_tokens, backend,
+                                                              signatures, normalize)
+        else:
+            doc1_aligned, doc2_aligned = align_pair(doc1_tokens, doc2_tokens, backend, signatures, normalize)
+        timer('analytics')
+        analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+        timings = timer.finish()
+        
+        result_cache.put(key, {
+            'statuses': list(STATUS_NAMES),
+            'tokens': doc1_aligned.table.tokens,
+            'doc1': encode_runs(doc1_aligned),
+            'doc2': encode_runs(doc2_aligned),
+            'analytics': analytics,
+            'line_differences': line_differences,
+            'success': True,
+            'doc1_name': doc1_name,
+            'doc2_name': doc2_name,
+            'timings': timings,
+            'etag': key
+        })
+        
+        start = {'etag': key, 'doc1_name': doc1_name, 'doc2_name': doc2_name, 'analytics': analytics,
+                 'line_differences': line_differences, 'timings': timings}
+        yield from _stream_events(start, doc1_aligned, doc2_aligned)
+        
+    except Exception as e:
+        yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+
+def stream_cached(key, payload):
+    """Yield a cached compact comparison using the same NDJSON events as stream_comparison"""
+    try:
+        start = {name: payload[name] for name in ('doc1_name', 'doc2_name', 'analytics', 'line_differences')}
+        start['etag'] = key
+        yield from _stream_events(start, aligned_from_runs(payload['tokens'], payload['doc1']),
+                                  aligned_from_runs(payload['tokens'], payload['doc2']))
+    except Exception as e:
+        yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+
+def cached_response(key, payload):
+    """Build a JSON response for a cached comparison, honouring If-None-Match"""
+    from flask import Response, request, jsonify
+    if request.if_none_match.contains(key):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(key)
+    return response
+
+BATCH_WORKERS = int(os.environ.get('XSUKAX_BATCH_WORKERS', 0)) or os.cpu_count() or 1
+
+_batch_state = {}
+
+def _init_batch_worker(base_tokens, backend, detail):
+    """Store the shared base document once per worker process"""
+    _batch_state.update(base_tokens=base_tokens, backend=backend, detail=detail)
+
+def _compare_batch_candidate(candidate_tokens):
+    """Diff one candidate against the worker's base document"""
+    doc1_aligned, doc2_aligned = compare_documents(_batch_state['base_tokens'], candidate_tokens,
+                                                   _batch_state['backend'])
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    result = {'analytics': analytics}
+    if _batch_state['detail']:
+        result['line_differences'] = line_differences
+    return result
+
+def compare_batch(base_tokens, candidates, backend=DEFAULT_DIFF_BACKEND, detail=False, max_workers=None):
+    """Compare one tokenized base against many (name, tokens) candidates, ranked by similarity.
+
+    The base is handed to each worker process once; candidates are diffed in
+    parallel across a ProcessPoolExecutor because the diff is CPU-bound.
+    When serving with a comparison_pool, each candidate is diffed in the pool
+    under its CPU limit instead.
+    """
+    if backend not in DIFF_BACKENDS:
+        raise ValueError(f"Unknown diff backend: {backend}")
+    
+    max_workers = min(max_workers or BATCH_WORKERS, len(candidates))
+    candidate_tokens = [tokens for _, tokens in candidates]
+    
+    if comparison_pool is not None:
+        outcomes = comparison_pool.map(_compare_corpus_pair, [(base_tokens, tokens, backend, detail)
+                                                               for tokens in candidate_tokens])
+    elif max_workers <= 1:
+        _init_batch_worker(base_tokens, backend, detail)
+        outcomes = [_compare_batch_candidate(tokens) for tokens in candidate_tokens]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker,
+                                 initargs=(base_tokens, backend, detail)) as executor:
+            outcomes = list(executor.map(_compare_batch_candidate, candidate_tokens))
+    
+    results = [dict(outcome, name=name) for (name, _), outcome in zip(candidates, outcomes)]
+    results.sort(key=lambda result: result['analytics']['similarity'], reverse=True)
+    for rank, result in enumerate(results, 1):
+        result['rank'] = rank
+    return results
+
+SHINGLE_WORDS = 4
+MINHASH_BINS = 64
+LSH_BANDS = 32
+EMPTY_BIN = 1 << 64
+CORPUS_MIN_SIMILARITY = 0.2
+
+def minhash_signature(tokenized_lines, shingle_words=SHINGLE_WORDS, bins=MINHASH_BINS):
+    """One-permutation MinHash of the word shingles of a tokenized document.
+
+    Each distinct shingle is hashed once; the hash picks a bin and the bin
+    keeps the smallest remaining value. Bins no shingle fell into hold EMPTY_BIN.
+    """
+    words = [token for line in tokenized_lines for token in line if token.strip()]
+    count = len(words) - shingle_words + 1 if len(words) >= shingle_words else min(len(words), 1)
+    shingles = {' '.join(words[i:i + shingle_words]) for i in range(count)}
+    
+    signature = [EMPTY_BIN] * bins
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = value % bins
+        value //= bins
+        if value < signature[index]:
+            signature[index] = value
+    return signature
+
+def estimate_jaccard(signature1, signature2):
+    """Estimate the shingle Jaccard similarity of two documents from their MinHash signatures"""
+    filled = matches = 0
+    for value1, value2 in zip(signature1, signature2):
+        if value1 != EMPTY_BIN or value2 != EMPTY_BIN:
+            filled += 1
+            matches += value1 == value2
+    return matches / filled if filled else 1.0
+
+class MinHashIndex:
+    """Locality-sensitive hashing index over MinHash signatures.
+
+    Signatures are cut into `bands`; documents sharing any whole band land in
+    the same bucket and become candidates, so a query only looks at documents
+    that are likely to be similar instead of the whole corpus.
+    """
+    
+    def __init__(self, bands=LSH_BANDS):
+        self.bands = bands
+        self.buckets = {}
+        self.signatures = {}
+    
+    def _band_keys(self, signature):
+        rows = len(signature) // self.bands
+        for band in range(self.bands):
+            values = tuple(signature[band * rows:(band + 1) * rows])
+            if any(value != EMPTY_BIN for value in values):
+                yield band, values
+    
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self.buckets.setdefault(band_key, []).append(key)
+    
+    def query(self, signature):
+        """Return (estimated similarity, key) for every candidate, most similar first"""
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self.buckets.get(band_key, ()))
+        return sorted(((estimate_jaccard(signature, self.signatures[key]), key) for key in candidates), reverse=True)
+
+def pair_corpus(old_documents, new_documents, min_similarity=CORPUS_MIN_SIMILARITY):
+    """Pair each new document with its most similar old one.
+
+    Documents are (name, digest, tokens) tuples. Byte-identical documents are
+    paired first; the rest are matched greedily on estimated similarity among
+    LSH candidates. Returns (pairs, added, removed) where pairs holds
+    (old_index, new_index, estimate) and added/removed hold unpaired indexes.
+    """
+    index = MinHashIndex()
+    old_by_digest = {}
+    for old_index, (_, digest, _) in enumerate(old_documents):
+        old_by_digest.setdefault(digest, []).append(old_index)
+    
+    pairs = []
+    paired_old = set()
+    paired_new = set()
+    for new_index, (_, digest, _) in enumerate(new_documents):
+        identical = [old_index for old_index in old_by_digest.get(digest, []) if old_index not in paired_old]
+        if identical:
+            pairs.append((identical[0], new_index, 1.0))
+            paired_old.add(identical[0])
+            paired_new.add(new_index)
+    
+    for old_index, (_, _, tokens) in enumerate(old_documents):
+        if old_index not in paired_old:
+            index.add(old_index, minhash_signature(tokens))
+    
+    edges = []
+    for new_index, (_, _, tokens) in enumerate(new_documents):
+        if new_index not in paired_new:
+            edges.extend((estimate, new_index, old_index) for estimate, old_index
+                         in index.query(minhash_signature(tokens)) if estimate >= min_similarity)
+    
+    for estimate, new_index, old_index in sorted(edges, reverse=True):
+        if old_index not in paired_old and new_index not in paired_new:
+            pairs.append((old_index, new_index, estimate))
+            paired_old.add(old_index)
+            paired_new.add(new_index)
+    
+    added = [i for i in range(len(new_documents)) if i not in paired_new]
+    removed = [i for i in range(len(old_documents)) if i not in paired_old]
+    return pairs, added, removed
+
+def _compare_corpus_pair(task):
+    """Diff one (old_tokens, new_tokens, backend, detail) corpus pair"""
+    old_tokens, new_tokens, backend, detail = task
+    doc1_aligned, doc2_aligned = compare_documents(old_tokens, new_tokens, backend)
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    result = {'analytics': analytics}
+    if detail:
+        result['line_differences'] = line_differences
+    return result
+
+def compare_corpus(old_documents, new_documents, backend=DEFAULT_DIFF_BACKEND, detail=False, max_workers=None):
+    """Match two collections of (name, digest, tokens) documents and diff only the matched pairs.
+
+    Pairs are found with pair_corpus, so the cost is one fingerprint per
+    document plus one diff per pair rather than a diff per combination.
+    Identical pairs skip the diff; the others run across a ProcessPoolExecutor,
+    or in the comparison_pool when serving with one.
+    Returns a summary report with per-pair analytics, least similar first.
+    """
+    if backend not in DIFF_BACKENDS:
+        raise ValueError(f"Unknown diff backend: {backend}")
+    
+    pairs, added, removed = pair_corpus(old_documents, new_documents)
+    
+    to_diff = [(old_index, new_index) for old_index, new_index, _ in pairs
+               if old_documents[old_index][1] != new_documents[new_index][1]]
+    tasks = [(old_documents[old_index][2], new_documents[new_index][2], backend, detail)
+             for old_index, new_index in to_diff]
+    max_workers = min(max_workers or BATCH_WORKERS, len(tasks))
+    if comparison_pool is not None:
+        outcomes = comparison_pool.map(_compare_corpus_pair, tasks)
+    elif max_workers <= 1:
+        outcomes = [_compare_corpus_pair(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            outcomes = list(executor.map(_compare_corpus_pair, tasks))
+    diffed = dict(zip(to_diff, outcomes))
+    
+    results = []
+    for old_index, new_index, estimate in pairs:
+        outcome = diffed.get((old_index, new_index))
+        if outcome is None:
+            words = sum(1 for line in old_documents[old_index][2] for token in line if token.strip())
+            outcome = {'analytics': {'total_words': words, 'added_words': 0, 'removed_words': 0,
+                                     'modified_words': 0, 'formatted_words': 0, 'similarity': 100.0}}
+            if detail:
+                outcome['line_differences'] = {'added': [], 'removed': [], 'modified': [], 'formatted': []}
+        results.append(dict(outcome, old_name=old_documents[old_index][0], new_name=new_documents[new_index][0],
+                            identical=(old_index, new_index) not in diffed,
+                            estimated_similarity=round(estimate * 100, 1)))
+    results.sort(key=lambda result: result['analytics']['similarity'])
+    
+    similarities = [result['analytics']['similarity'] for result in results]
+    summary = {
+        'old_documents': len(old_documents),
+        'new_documents': len(new_documents),
+        'paired': len(pairs),
+        'identical': len(pairs) - len(to_diff),
+        'changed': sum(1 for similarity in similarities if similarity < 100),
+        'added': len(added),
+        'removed': len(removed),
+        'diffs_run': len(to_diff),
+        'average_similarity': round(sum(similarities) / len(similarities), 1) if similarities else None
+    }
+    
+    return {
+        'summary': summary,
+        'pairs': results,
+        'added': [new_documents[i][0] for i in added],
+        'removed': [old_documents[i][0] for i in removed]
+    }
+
+SIMILARITY_METHODS = ('real_quick', 'quick', 'overlap', 'sketch', 'exact')
+SKETCH_MARGIN = 10.0
+_MASK64 = (1 << 64) - 1
+
+def similarity_profile(tokenized_lines):
+    """Summarize a document for estimate_similarity: word count, word multiset and MinHash sketch.
+
+    The sketch covers the word multiset (the k-th occurrence of a word is its
+    own element), so its Jaccard estimate is on the same scale as `overlap`.
+    """
+    counts = Counter(token for line in tokenized_lines for token in line if token.strip())
+    sketch = [EMPTY_BIN] * MINHASH_BINS
+    for word, count in counts.items():
+        base = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+        for occurrence in range(count):
+            value = (base + occurrence * 0x9E3779B97F4A7C15) & _MASK64
+            value = ((value ^ (value >> 31)) * 0xBF58476D1CE4E5B9) & _MASK64
+            index = value % MINHASH_BINS
+            value //= MINHASH_BINS
+            if value < sketch[index]:
+                sketch[index] = value
+    return {'words': sum(counts.values()), 'counts': dict(counts), 'sketch': sketch}
+
+def estimate_similarity(doc1_tokens, doc2_tokens, method='overlap', threshold=None,
+                        backend=DEFAULT_DIFF_BACKEND, profiles=None):
+    """Estimate the analytics similarity (0-100) of two tokenized documents without rendering.
+
+    `real_quick`, `quick` and `overlap` are upper bounds of increasing
+    tightness: word-count ratio, difflib's quick_ratio over the word multisets,
+    and the multiset intersection over the longer word count. `sketch`
+    estimates `overlap` from the MinHash sketches and `exact` runs the word
+    alignment. With `threshold`, the exact similarity is computed only when
+    the estimate cannot tell on its own whether the similarity reaches it.
+    `profiles` may pass precomputed similarity_profile results for both documents.
+    Returns a dict with `similarity`, the `method` used and its `kind`.
+    """
+    if method not in SIMILARITY_METHODS:
+        raise ValueError(f"Unknown similarity method: {method}")
+    
+    if method != 'exact':
+        profile1, profile2 = profiles or (similarity_profile(doc1_tokens), similarity_profile(doc2_tokens))
+        words1, words2 = profile1['words'], profile2['words']
+        longest = max(words1, words2)
+        
+        if method == 'real_quick':
+            matches = min(words1, words2)
+        elif method == 'sketch':
+            jaccard = estimate_jaccard(profile1['sketch'], profile2['sketch'])
+            matches = jaccard * (words1 + words2) / (1 + jaccard)
+        else:
+            counts1, counts2 = sorted((profile1['counts'], profile2['counts']), key=len)
+            matches = sum(min(count, counts2.get(word, 0)) for word, count in counts1.items())
+        
+        if method in ('overlap', 'sketch'):
+            similarity = matches / longest * 100 if longest else 100.0
+        else:
+            similarity = 2 * matches / (words1 + words2) * 100 if longest else 100.0
+        kind = 'estimate' if method == 'sketch' else 'upper_bound'
+        
+        undecided = threshold is not None and (similarity >= threshold if kind == 'upper_bound'
+                                               else abs(similarity - threshold) < SKETCH_MARGIN)
+        if not undecided:
+            return {'similarity': round(similarity, 1), 'method': method, 'kind': kind}
+    
+    doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens, backend)
+    analytics = summarize_alignment(doc1_aligned, doc2_aligned)[0]
+    return {'similarity': analytics['similarity'], 'method': 'exact', 'kind': 'exact'}
+
+JOB_STAGES = ('extract', 'tokenize', 'diff', 'render', 'analytics')
+
+class JobCancelled(Exception):
+    """Raised inside a running job once its cancellation has been requested"""
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds its maximum number of pending jobs"""
+
+class ComparisonJob:
+    """State of one queued comparison, updated by the worker thread as it progresses"""
+    
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'queued'
+        self.stage = None
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.cleanup = None
+        self.cancel_requested = threading.Event()
+    
+    def release(self):
+        """Run the job's cleanup callback, if any, once the job has finished or was cancelled before starting"""
+        cleanup, self.cleanup = self.cleanup, None
+        if cleanup is not None:
+            cleanup()
+    
+    def advance(self, stage):
+        """Record the stage being entered, aborting if cancellation was requested"""
+        if self.cancel_requested.is_set():
+            raise JobCancelled()
+        self.stage = stage
+    
+    def to_dict(self):
+        if self.status == 'done':
+            progress = 100
+        elif self.stage in JOB_STAGES:
+            progress = round(JOB_STAGES.index(self.stage) / len(JOB_STAGES) * 100)
+        else:
+            progress = 0
+        
+        info = {
+            'success': self.status != 'failed',
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'stages': list(JOB_STAGES),
+            'progress': progress
+        }
+        if self.error:
+            info['error'] = self.error
+        if self.status == 'done':
+            info['result'] = self.result
+        return info
+
+class JobQueue:
+    """Bounded in-process job queue running comparisons on a thread pool.
+
+    At most `max_pending` jobs may be queued or running at once; further
+    submissions raise QueueFullError. Finished jobs are kept for polling until
+    more than `history` of them accumulate.
+    """
+    
+    def __init__(self, workers=2, max_pending=16, history=100):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='compare-job')
+    
+    def submit(self, func, *args, cleanup=None):
+        """Queue func(job, *args); `cleanup` runs when the job finishes or is cancelled while queued"""
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.finished is None)
+            if active >= self.max_pending:
+                raise QueueFullError('Too many comparisons in progress, please retry shortly')
+            job = ComparisonJob(uuid.uuid4().hex)
+            job.cleanup = cleanup
+            self._jobs[job.id] = job
+            self._prune()
+        
+        job.future = self._executor.submit(self._run, job, func, args)
+        return job
+    
+    def _run(self, job, func, args):
+        try:
+            job.advance(None)
+            job.status = 'running'
+            job.result = func(job, *args)
+            job.status = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            job.release()
+    
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            del self._jobs[job_id]
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def status_counts(self):
+        """Count the jobs currently held by the queue per status"""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'cancelling', 'done',
+                                                              'failed', 'cancelled')}
+    
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and job.finished is None:
+            job.cancel_requested.set()
+            if job.future is not None and job.future.cancel():
+                job.status = 'cancelled'
+                job.finished = time.time()
+                job.release()
+            else:
+                job.status = 'cancelling'
+        return job
+
+job_queue = JobQueue(
+    workers=int(os.environ.get('XSUKAX_JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('XSUKAX_JOB_QUEUE_LIMIT', 16))
+)
+
+# Sessions hold live ComparisonSession objects, so they are kept in memory only
+comparison_sessions = ContentCache(
+    'sessions',
+    max_entries=int(os.environ.get('XSUKAX_SESSION_LIMIT', 16)),
+    ttl=float(os.environ.get('XSUKAX_SESSION_TTL', 1800))
+)
+
+def _pooled_session_comparison(session, doc2_tokens):
+    """Pool task: compare a revision within a session, returning the updated session and the alignment"""
+    return session, session.compare(doc2_tokens)
+
+def run_session_comparison(session_id, entry, doc2_tokens, doc2_name):
+    """Compare a new revision of document 2 within a session and return the compact payload.
+
+    The first comparison is a full diff: with a comparison_pool it runs in a
+    worker under the CPU limit, and the session is pickled there and back
+    once. Later revisions only re-diff the edited hunks, so they run on the
+    resident session in this process rather than paying O(document)
+    serialization each time; they are not subject to the CPU limit. The
+    entry lock keeps revisions in order.
+    """
+    timer = StageTimer()
+    timer('diff')
+    with entry['lock']:
+        if comparison_pool is not None and entry['session'].revisions == 0:
+            entry['session'], (doc1_aligned, doc2_aligned) = comparison_pool.call(
+                _pooled_session_comparison, entry['session'], doc2_tokens)
+        else:
+            doc1_aligned, doc2_aligned = entry['session'].compare(doc2_tokens)
+        session = entry['session']
+    
+    timer('render')
+    doc1_runs = encode_runs(doc1_aligned)
+    doc2_runs = encode_runs(doc2_aligned)
+    
+    timer('analytics')
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    entry['aligned'] = (doc1_aligned, doc2_aligned)
+    entry.pop('hunks', None)
+    
+    return {
+        'success': True,
+        'session_id': session_id,
+        'revision': session.revisions,
+        'doc1_name': entry['doc1_name'],
+        'doc2_name': doc2_name,
+        'statuses': list(STATUS_NAMES),
+        'tokens': session.table.tokens,
+        'doc1': doc1_runs,
+        'doc2': doc2_runs,
+        'analytics': analytics,
+        'line_differences': line_differences,
+        'incremental': {'diffed_hunks': session.diffed_hunks, 'reused_hunks': session.reused_hunks},
+        'timings': timer.finish()
+    }
+
+def _comparison_job(job, doc1_stream, doc2_stream, doc1_name, doc2_name, backend, compact, formatting, normalize):
+    """Job body: run the comparison pipeline, reporting each stage on the job"""
+    key, payload = resolve_comparison(doc1_stream, doc2_stream, doc1_name, doc2_name, backend, compact,
+                                      job.advance, formatting, normalize)
+    return dict(payload, etag=key)
+
+def submit_comparison_job(doc1_file, doc2_file, backend, compact, formatting=False, normalize=()):
+    """Queue a comparison of the uploaded pair and answer 202 with the job id"""
+    from flask import jsonify
+    doc1_stream = spool_upload(doc1_file)
+    doc2_stream = spool_upload(doc2_file)
+    
+    def close_streams():
+        doc1_stream.close()
+        doc2_stream.close()
+    
+    try:
+        job = job_queue.submit(_comparison_job, doc1_stream, doc2_stream, doc1_file.filename, doc2_file.filename,
+                               backend, compact, formatting, normalize, cleanup=close_streams)
+    except QueueFullError as e:
+        close_streams()
+        response = jsonify({'success': False, 'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    
+    return jsonify({'success': True, 'job_id': job.id, 'status_url': f'/jobs/{job.id}'}), 202
+
+def read_upload_pair():
+    """Validate the uploaded documents and diff backend of the current request"""
+    from flask import request
+    if 'doc1' not in request.files or 'doc2' not in request.files:
+        raise ValueError('Please upload both documents')
+    
+    doc1_file = request.files['doc1']
+    doc2_file = request.files['doc2']
+    
+    if doc1_file.filename == '' or doc2_file.filename == '':
+        raise ValueError('Please select both files')
+    
+    if not doc1_file.filename.lower().endswith('.docx') or not doc2_file.filename.lower().endswith('.docx'):
+        raise ValueError('Only .docx files are supported')
+    
+    backend = request.form.get('backend', DEFAULT_DIFF_BACKEND)
+    if backend not in DIFF_BACKENDS:
+        raise ValueError(f'Unknown diff backend: {backend}')
+    
+    return doc1_file, doc2_file, backend
+
+def not_modified_response(doc1_file, doc2_file, options):
+    """Return 304 when If-None-Match names the result of the uploaded pair with these options, else None.
+
+    Only the upload digests are computed; the documents are not extracted.
+    """
+    from flask import Response, request
+    if not request.if_none_match:
+        return None
+    key = comparison_key(stream_digest(doc1_file.stream), stream_digest(doc2_file.stream), options)
+    if not request.if_none_match.contains(key):
+        return None
+    response = Response(status=304)
+    response.set_etag(key)
+    return response
+
+@route('/compare', methods=['POST'])
+def compare():
+    """Handle document comparison"""
+    from flask import Response, request, jsonify, stream_with_context
+    try:
+        doc1_file, doc2_file, backend = read_upload_pair()
+        formatting = request.form.get('formatting') == '1'
+        normalize = parse_normalization(request.form.getlist('normalize'))
+        streamed = request.values.get('stream') == '1'
+        
+        if streamed:
+            options = comparison_options(backend, formatting, normalize, format='compact')
+        else:
+            options = comparison_options(backend, formatting, normalize)
+        response = not_modified_response(doc1_file, doc2_file, options)
+        if response is not None:
+            return response
+        
+        if request.form.get('mode') == 'job':
+            return submit_comparison_job(doc1_file, doc2_file, backend, compact=False, formatting=formatting,
+                                         normalize=normalize)
+        
+        if streamed:
+            pair = load_pair(doc1_file.stream, doc2_file.stream, formatting)
+            doc1_digest, doc1_tokens, doc2_digest, doc2_tokens, signatures = pair
+            
+            key = comparison_key(doc1_digest, doc2_digest, options)
+            payload = result_cache.get(key)
+            if payload is None:
+                events = stream_comparison(key, doc1_tokens, doc2_tokens, backend,
+                                           doc1_file.filename, doc2_file.filename, signatures, normalize)
+            else:
+                events = stream_cached(key, dict(payload, doc1_name=doc1_file.filename, doc2_name=doc2_file.filename))
+            response = Response(stream_with_context(events), mimetype='application/x-ndjson')
+            response.set_etag(key)
+            return response
+        
+        key, payload = resolve_comparison(doc1_file.stream, doc2_file.stream, doc1_file.filename,
+                                          doc2_file.filename, backend, formatting=formatting, normalize=normalize)
+        return cached_response(key, payload)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/api/compare', methods=['POST'])
+def api_compare():
+    """Handle document comparison returning the compact run-length encoded diff"""
+    from flask import request, jsonify
+    try:
+        doc1_file, doc2_file, backend = read_upload_pair()
+        formatting = request.form.get('formatting') == '1'
+        normalize = parse_normalization(request.form.getlist('normalize'))
+        
+        response = not_modified_response(doc1_file, doc2_file,
+                                         comparison_options(backend, formatting, normalize, format='compact'))
+        if response is not None:
+            return response
+        
+        if request.form.get('mode') == 'job':
+            return submit_comparison_job(doc1_file, doc2_file, backend, compact=True, formatting=formatting,
+                                         normalize=normalize)
+        
+        key, payload = resolve_comparison(doc1_file.stream, doc2_file.stream, doc1_file.filename, doc2_file.filename,
+                                          backend, compact=True, formatting=formatting, normalize=normalize)
+        return cached_response(key, payload)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/compare/sections', methods=['POST'])
+def compare_sections_route():
+    """Compare body, tables, text boxes, headers, footers, notes and comments section by section"""
+    from flask import jsonify
+    try:
+        doc1_file, doc2_file, backend = read_upload_pair()
+        options = {'backend': backend, 'format': 'sections'}
+        response = not_modified_response(doc1_file, doc2_file, options)
+        if response is not None:
+            return response
+        
+        doc1_digest, doc1_sections = load_document_sections(doc1_file.stream)
+        doc2_digest, doc2_sections = load_document_sections(doc2_file.stream)
+        
+        key = comparison_key(doc1_digest, doc2_digest, options)
+        payload = result_cache.get(key)
+        if payload is None:
+            if comparison_pool is not None:
+                analytics, sections = comparison_pool.call(compare_sections, doc1_sections, doc2_sections, backend)
+            else:
+                analytics, sections = compare_sections(doc1_sections, doc2_sections, backend)
+            payload = {'success': True, 'analytics': analytics, 'sections': sections}
+            result_cache.put(key, payload)
+        
+        payload = dict(payload, doc1_name=doc1_file.filename, doc2_name=doc2_file.filename)
+        return cached_response(key, payload)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/compare/batch', methods=['POST'])
+def compare_batch_route():
+    """Compare one base document against many candidate revisions"""
+    from flask import request, jsonify
+    try:
+        base_file = request.files.get('base')
+        candidate_files = [file for file in request.files.getlist('candidates') if file.filename]
+        
+        if base_file is None or base_file.filename == '' or not candidate_files:
+            return jsonify({'success': False, 'error': 'Please upload a base document and at least one candidate'})
+        
+        if not all(file.filename.lower().endswith('.docx') for file in [base_file] + candidate_files):
+            return jsonify({'success': False, 'error': 'Only .docx files are supported'})
+        
+        backend = request.form.get('backend', DEFAULT_DIFF_BACKEND)
+        if backend not in DIFF_BACKENDS:
+            return jsonify({'success': False, 'error': f'Unknown diff backend: {backend}'})
+        
+        _, _, base_tokens = load_document(base_file.stream)
+        candidates = [(file.filename, load_document(file.stream)[2]) for file in candidate_files]
+        
+        results = compare_batch(base_tokens, candidates, backend, detail=request.form.get('detail') == '1')
+        
+        return jsonify({
+            'success': True,
+            'base_name': base_file.filename,
+            'backend': backend,
+            'results': results
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/metrics')
+def metrics_endpoint():
+    """Expose request, pipeline, cache and queue metrics in the Prometheus text format"""
+    from flask import Response
+    samples = []
+    for cache in (document_cache, result_cache, comparison_sessions, alignment_cache):
+        stats = cache.stats()
+        for result, field in (('hit', 'hits'), ('disk_hit', 'disk_hits'), ('miss', 'misses')):
+            samples.append(('xsukax_cache_lookups_total', 'counter', 'Cache lookups by cache and result',
+                            {'cache': cache.name, 'result': result}, stats[field]))
+        samples.append(('xsukax_cache_entries', 'gauge', 'Entries held in memory by each cache',
+                        {'cache': cache.name}, stats['entries']))
+    
+    for status, count in job_queue.status_counts().items():
+        samples.append(('xsukax_jobs', 'gauge', 'Comparison jobs by status', {'status': status}, count))
+    
+    return Response(metrics.render(samples), mimetype='text/plain; version=0.0.4')
+
+def load_uploaded_corpus(files):
+    """Load uploaded documents as (filename, digest, tokens) for compare_corpus"""
+    documents = []
+    for file in files:
+        digest, _, tokens = load_document(file.stream)
+        documents.append((file.filename, digest, tokens))
+    return documents
+
+@route('/compare/corpus', methods=['POST'])
+def compare_corpus_route():
+    """Match a set of old documents with a set of new ones and compare the matched pairs"""
+    from flask import request, jsonify
+    try:
+        old_files = [file for file in request.files.getlist('old') if file.filename]
+        new_files = [file for file in request.files.getlist('new') if file.filename]
+        
+        if not old_files or not new_files:
+            return jsonify({'success': False, 'error': 'Please upload at least one old and one new document'})
+        
+        if not all(file.filename.lower().endswith('.docx') for file in old_files + new_files):
+            return jsonify({'success': False, 'error': 'Only .docx files are supported'})
+        
+        backend = request.form.get('backend', DEFAULT_DIFF_BACKEND)
+        if backend not in DIFF_BACKENDS:
+            return jsonify({'success': False, 'error': f'Unknown diff backend: {backend}'})
+        
+        old_documents = load_uploaded_corpus(old_files)
+        new_documents = load_uploaded_corpus(new_files)
+        
+        report = compare_corpus(old_documents, new_documents, backend, detail=request.form.get('detail') == '1')
+        return jsonify(dict(report, success=True, backend=backend))
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+def load_similarity_profile(digest, tokens):
+    """Return the similarity_profile of a loaded document, cached by its digest"""
+    cache_key = f'profile:{DEFAULT_EXTRACTOR}:{digest}'
+    profile = document_cache.get(cache_key)
+    if profile is None:
+        profile = similarity_profile(tokens)
+        document_cache.put(cache_key, profile)
+    return profile
+
+@route('/similarity', methods=['POST'])
+def similarity():
+    """Estimate how similar two documents are without aligning or rendering them in full"""
+    from flask import request, jsonify
+    try:
+        doc1_file, doc2_file, backend = read_upload_pair()
+        
+        method = request.form.get('method', 'overlap')
+        threshold = request.form.get('threshold')
+        threshold = float(threshold) if threshold else None
+        
+        started = time.perf_counter()
+        doc1_digest, _, doc1_tokens = load_document(doc1_file.stream)
+        doc2_digest, _, doc2_tokens = load_document(doc2_file.stream)
+        profiles = (load_similarity_profile(doc1_digest, doc1_tokens), load_similarity_profile(doc2_digest, doc2_tokens))
+        if comparison_pool is not None and (method == 'exact' or threshold is not None):
+            result = comparison_pool.call(estimate_similarity, doc1_tokens, doc2_tokens, method, threshold,
+                                          backend, profiles)
+        else:
+            result = estimate_similarity(doc1_tokens, doc2_tokens, method, threshold, backend, profiles)
+        
+        return jsonify(dict(result, success=True, doc1_name=doc1_file.filename, doc2_name=doc2_file.filename,
+                            elapsed_ms=round((time.perf_counter() - started) * 1000, 2)))
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/sessions', methods=['POST'])
+def create_session():
+    """Start an incremental comparison session for a document pair"""
+    from flask import request, jsonify
+    try:
+        doc1_file, doc2_file, backend = read_upload_pair()
+        
+        _, _, doc1_tokens = load_document(doc1_file.stream)
+        _, _, doc2_tokens = load_document(doc2_file.stream)
+        
+        normalize = parse_normalization(request.form.getlist('normalize'))
+        session_id = uuid.uuid4().hex
+        entry = {'session': ComparisonSession(doc1_tokens, backend, normalize), 'doc1_name': doc1_file.filename,
+                 'lock': threading.Lock()}
+        comparison_sessions.put(session_id, entry)
+        return jsonify(run_session_comparison(session_id, entry, doc2_tokens, doc2_file.filename))
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/sessions/<session_id>', methods=['POST', 'DELETE'])
+def update_session(session_id):
+    """Re-compare a revised document 2 within a session, or end the session"""
+    from flask import request, jsonify
+    entry = comparison_sessions.get(session_id)
+    if entry is None:
+        return jsonify({'success': False, 'error': 'Session not found or expired'}), 404
+    
+    if request.method == 'DELETE':
+        comparison_sessions.discard(session_id)
+        return jsonify({'success': True, 'session_id': session_id})
+    
+    try:
+        doc2_file = request.files.get('doc2')
+        if doc2_file is None or doc2_file.filename == '':
+            return jsonify({'success': False, 'error': 'Please upload the revised document'})
+        
+        if not doc2_file.filename.lower().endswith('.docx'):
+            return jsonify({'success': False, 'error': 'Only .docx files are supported'})
+        
+        _, _, doc2_tokens = load_document(doc2_file.stream)
+        comparison_sessions.put(session_id, entry)
+        return jsonify(run_session_comparison(session_id, entry, doc2_tokens, doc2_file.filename))
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+def job_status(job_id):
+    """Report the progress and result of a queued comparison, or cancel it"""
+    from flask import request, jsonify
+    if request.method == 'DELETE':
+        job = job_queue.cancel(job_id)
+    else:
+        job = job_queue.get(job_id)
+    
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@route('/compare/<key>')
+def compare_cached(key):
+    """Return a previously computed comparison by its ETag without re-uploading"""
+    from flask import jsonify
+    payload = result_cache.get(key)
+    if payload is None:
+        return jsonify({'success': False, 'error': 'Comparison not found or expired'}), 404
+    return cached_response(key, payload)
+
+def cached_hunks(key):
+    """Return AlignedHunks for the compact comparison stored under `key`, or None"""
+    hunks = alignment_cache.get(key)
+    if hunks is None:
+        payload = result_cache.get(key)
+        if payload is None or 'tokens' not in payload:
+            return None
+        hunks = AlignedHunks(aligned_from_runs(payload['tokens'], payload['doc1']),
+                             aligned_from_runs(payload['tokens'], payload['doc2']))
+        alignment_cache.put(key, hunks)
+    return hunks
+
+@route('/compare/<key>/lines/<int:line>')
+def refine_cached_line(key, line):
+    """Refine the changes on one line of a stored compact comparison to character or sentence level"""
+    from flask import request, jsonify
+    try:
+        hunks = cached_hunks(key)
+        if hunks is None:
+            return jsonify({'success': False, 'error': 'Compact comparison not found or expired'}), 404
+        
+        level = request.args.get('level', 'char')
+        return jsonify({'success': True, 'etag': key, 'line': line, 'hunks': refine_line(hunks, line, level)})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/sessions/<session_id>/lines/<int:line>')
+def refine_session_line(session_id, line):
+    """Refine the changes on one line of the latest revision compared in a session"""
+    from flask import request, jsonify
+    entry = comparison_sessions.get(session_id)
+    if entry is None:
+        return jsonify({'success': False, 'error': 'Session not found or expired'}), 404
+    
+    try:
+        hunks = entry.get('hunks')
+        if hunks is None:
+            hunks = entry['hunks'] = AlignedHunks(*entry['aligned'])
+        
+        level = request.args.get('level', 'char')
+        return jsonify({'success': True, 'session_id': session_id, 'revision': entry['session'].revisions,
+                        'line': line, 'hunks': refine_line(hunks, line, level)})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@route('/cache/stats')
+def cache_stats():
+    """Report document, result, session and alignment cache counters"""
+    from flask import jsonify
+    return jsonify({'documents': document_cache.stats(), 'results': result_cache.stats(),
+                    'sessions': comparison_sessions.stats(), 'alignments': alignment_cache.stats()})
+
+def compare_files(doc1_path, doc2_path, backend=DEFAULT_DIFF_BACKEND, extractor=None, formatting=False, normalize=()):
+    """Compare two .docx files without the web server.
+
+    Returns a dict with the document names and texts, `analytics`,
+    `line_differences` and the aligned documents as `doc1_aligned` and
+    `doc2_aligned` (AlignedLines, renderable with generate_html_content).
+    """
+    with open(doc1_path, 'rb') as doc1_stream, open(doc2_path, 'rb') as doc2_stream:
+        if formatting:
+            _, doc1_text, doc1_tokens, doc1_signatures = load_document_formatting(doc1_stream)
+            _, doc2_text, doc2_tokens, doc2_signatures = load_document_formatting(doc2_stream)
+        else:
+            _, doc1_text, doc1_tokens = load_document(doc1_stream, extractor=extractor)
+            _, doc2_text, doc2_tokens = load_document(doc2_stream, extractor=extractor)
+    
+    doc1_aligned, doc2_aligned = compare_documents(doc1_tokens, doc2_tokens, backend, normalize)
+    if formatting:
+        mark_formatting_changes(doc1_aligned, doc2_aligned, doc1_signatures, doc2_signatures)
+    analytics, line_differences = summarize_alignment(doc1_aligned, doc2_aligned)
+    
+    return {
+        'doc1_name': doc1_path,
+        'doc2_name': doc2_path,
+        'doc1_text': doc1_text,
+        'doc2_text': doc2_text,
+        'backend': backend,
+        'analytics': analytics,
+        'line_differences': line_differences,
+        'doc1_aligned': doc1_aligned,
+        'doc2_aligned': doc2_aligned
+    }
+
+REPORT_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>{title}</title>
+    {styles}
+</head>
+<body>
+    <div class="container">
+        <div class="analytics-panel">{cards}</div>
+        <div class="comparison-header">
+            <div class="document-title">{doc1_name}</div>
+            <div class="document-title">{doc2_name}</div>
+        </div>
+        <div class="comparison-container">
+            <div class="document-panel"><div class="document-content">{doc1_html}</div></div>
+            <div class="document-panel"><div class="document-content">{doc2_html}</div></div>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+REPORT_CARDS = (
+    ('', 'Total Words', 'total_words', ''),
+    ('similarity', 'Similarity', 'similarity', '%'),
+    ('added', 'Added', 'added_words', ''),
+    ('removed', 'Removed', 'removed_words', ''),
+    ('modified', 'Modified', 'modified_words', ''),
+    ('formatted', 'Formatting', 'formatted_words', ''),
+)
+
+def render_html_report(result):
+    """Render a compare_files result as a standalone HTML page styled like the web UI"""
+    styles = HTML_TEMPLATE[HTML_TEMPLATE.index('<style>'):HTML_TEMPLATE.index('</style>') + len('</style>')]
+    cards = ''.join(f'<div class="analytics-card {css}"><h4>{label}</h4>'
+                    f'<div class="value">{result["analytics"][field]}{suffix}</div></div>'
+                    for css, label, field, suffix in REPORT_CARDS)
+    names = [name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+             for name in (result['doc1_name'], result['doc2_name'])]
+    return REPORT_TEMPLATE.format(
+        title=f'{names[0]} vs {names[1]}',
+        styles=styles,
+        cards=cards,
+        doc1_name=names[0],
+        doc2_name=names[1],
+        doc1_html=generate_html_content(result['doc1_aligned']),
+        doc2_html=generate_html_content(result['doc2_aligned'])
+    )
+
+def render_unified_diff(result, context=3):
+    """Render a compare_files result as a line-level unified diff of the extracted text"""
+    lines = unified_diff(result['doc1_text'].split('\n'), result['doc2_text'].split('\n'),
+                         fromfile=result['doc1_name'], tofile=result['doc2_name'], n=context, lineterm='')
+    return '\n'.join(lines) + '\n'
+
+def run_compare_command(args):
+    """Run the `compare` command; the exit status is 0 when the documents match and 1 otherwise"""
+    result = compare_files(args.doc1, args.doc2, args.backend, args.extractor, args.formatting, args.normalize)
+    
+    if args.format == 'html':
+        output = render_html_report(result)
+    elif args.format == 'unified':
+        output = render_unified_diff(result, args.context)
+    else:
+        fields = ('doc1_name', 'doc2_name', 'backend', 'analytics', 'line_differences')
+        output = json.dumps({field: result[field] for field in fields}, indent=2, ensure_ascii=False) + '\n'
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as stream:
+            stream.write(output)
+    else:
+        print(output, end='')
+    
+    line_differences = result['line_differences']
+    return 1 if any(line_differences[kind] for kind in line_differences) else 0
+
+def run_batch_command(args):
+    """Run the `batch` command and print ranked results as JSON"""
+    with open(args.base, 'rb') as base_stream:
+        _, _, base_tokens = load_document(base_stream, extractor=args.extractor)
+    
+    candidates = []
+    for path in args.candidates:
+        with open(path, 'rb') as candidate_stream:
+            candidates.append((path, load_document(candidate_stream, extractor=args.extractor)[2]))
+    
+    results = compare_batch(base_tokens, candidates, args.backend, detail=args.detail, max_workers=args.workers)
+    print(json.dumps({'base_name': args.base, 'backend': args.backend, 'results': results},
+                     indent=2, ensure_ascii=False))
+
+LATIN_SYLLABLES = ('ka', 'lo', 'mi', 'ra', 'ten', 'vo', 'sun', 'pel', 'dor', 'qui', 'ba', 'ne', 'tis', 'mor', 'al', 'ex')
+ARABIC_LETTERS = 'ابتثجحخدذرزسشصضطظعغفقكلمنهوي'
+
+def _synthetic_word(rng, rtl):
+    if rtl:
+        return ''.join(rng.choice(ARABIC_LETTERS) for _ in range(rng.randint(2, 7)))
+    return ''.join(rng.choice(LATIN_SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+def generate_document_pair(paragraphs=200, edit_rate=0.05, clustering=0.0, rtl=False, tables=0, seed=0):
+    """Build a synthetic original/revised pair of .docx files and return their bytes.
+
+    About `edit_rate` of the words are replaced, inserted or deleted, and some
+    paragraphs are added or removed. `clustering` (0-1) is the chance that an
+    edit lands within a few paragraphs of the previous one instead of anywhere.
+    `rtl` generates Arabic text; `tables` adds that many small tables whose
+    cells are edited at the same rate.
+    """
+    from docx import Document
+    
+    rng = random.Random(seed)
+    vocabulary = [_synthetic_word(rng, rtl) for _ in range(2000)]
+    original = [[rng.choice(vocabulary) for _ in range(rng.randint(8, 40))] for _ in range(paragraphs)]
+    table_rows = [rng.randint(3, 6) for _ in range(tables)]
+    cells = [[[rng.choice(vocabulary) for _ in range(rng.randint(1, 4))] for _ in range(rng.randint(2, 4))]
+             for _ in range(sum(table_rows))]
+    table_positions = sorted(rng.randrange(paragraphs + 1) for _ in range(tables))
+    
+    revised = [list(words) for words in original]
+    revised_cells = [[list(cell) for cell in row] for row in cells]
+    edits = round(sum(len(words) for words in original) * edit_rate)
+    position = rng.randrange(paragraphs) if paragraphs else 0
+    for _ in range(edits if revised else 0):
+        if rng.random() < clustering:
+            position = min(max(position + rng.randint(-3, 3), 0), len(revised) - 1)
+        else:
+            position = rng.randrange(len(revised))
+        words = revised[position]
+        kind = rng.random()
+        if kind < 0.04 and len(revised) > 1:
+            del revised[position]
+            position = min(position, len(revised) - 1)
+        elif kind < 0.08:
+            revised.insert(position, [rng.choice(vocabulary) for _ in range(rng.randint(8, 40))])
+        elif kind < 0.5 or len(words) < 2:
+            words[rng.randrange(len(words))] = rng.choice(vocabulary)
+        elif kind < 0.75:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(vocabulary))
+        else:
+            del words[rng.randrange(len(words))]
+    for row in revised_cells:
+        for cell in row:
+            if rng.random() < edit_rate * 4:
+                cell[rng.randrange(len(cell))] = rng.choice(vocabulary)
+    
+    def build(paragraph_words, row_cells):
+        doc = Document()
+        rows = iter(row_cells)
+        table_index = 0
+        for index, words in enumerate(paragraph_words + [None]):
+            while table_index < tables and table_positions[table_index] <= index:
+                row_group = [next(rows) for _ in range(table_rows[table_index])]
+                table = doc.add_table(rows=0, cols=max(len(row) for row in row_group))
+                for row in row_group:
+                    table_cells = table.add_row().cells
+                    for col, cell in enumerate(row):
+                        table_cells[col].text = ' '.join(cell)
+                table_index += 1
+            if words is not None:
+                doc.add_paragraph(' '.join(words))
+        stream = io.BytesIO()
+        doc.save(stream)
+        return stream.getvalue()
+    
+    return build(original, cells), build(revised, revised_cells)
+
+BENCH_STAGES = ('extract_text_from_docx', 'tokenize_text', 'compare_documents',
+                'generate_html_content', 'calculate_analytics', 'analyze_line_differences')
+
+def _run_pipeline_stages(doc1_data, doc2_data, backend):
+    """Run the comparison pipeline once, returning the seconds spent in each of BENCH_STAGES"""
+    timings = {}
+    
+    def timed(stage, func, *args):
+        started = time.perf_counter()
+        value = func(*args)
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - started
+        return value
+    
+    doc1_text = timed('extract_text_from_docx', extract_text_from_docx, io.BytesIO(doc1_data))
+    doc2_text = timed('extract_text_from_docx', extract_text_from_docx, io.BytesIO(doc2_data))
+    doc1_tokens = timed('tokenize_text', tokenize_text, doc1_text)
+    doc2_tokens = timed('tokenize_text', tokenize_text, doc2_text)
+    doc1_aligned, doc2_aligned = timed('compare_documents', compare_documents, doc1_tokens, doc2_tokens, backend)
+    timed('generate_html_content', generate_html_content, doc1_aligned)
+    timed('generate_html_content', generate_html_content, doc2_aligned)
+    analytics = timed('calculate_analytics', calculate_analytics, doc1_aligned, doc2_aligned)
+    timed('analyze_line_differences', analyze_line_differences, doc1_aligned, doc2_aligned)
+    return timings, analytics
+
+def benchmark_pipeline(sizes=(100, 1000, 5000), edit_rate=0.05, clustering=0.0, rtl=False, tables=0,
+                       backend=DEFAULT_DIFF_BACKEND, repeat=3, seed=0):
+    """Time every pipeline stage on synthetic document pairs of increasing size.
+
+    For each size in paragraphs the best of `repeat` runs is kept per stage,
+    throughput is reported in words per second and peak memory is measured
+    with tracemalloc in a separate run. `scaling` holds the log-log slope of
+    each stage's time against the word count (1.0 means linear).
+    """
+    points = []
+    for size in sizes:
+        doc1_data, doc2_data = generate_document_pair(size, edit_rate, clustering, rtl, tables, seed)
+        
+        best = {}
+        for _ in range(repeat):
+            timings, analytics = _run_pipeline_stages(doc1_data, doc2_data, backend)
+            for stage, elapsed in timings.items():
+                best[stage] = min(best.get(stage, elapsed), elapsed)
+        
+        tracemalloc.start()
+        try:
+            _run_pipeline_stages(doc1_data, doc2_data, backend)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        
+        total = sum(best.values())
+        words = analytics['total_words']
+        points.append({
+            'paragraphs': size,
+            'words': words,
+            'bytes': len(doc1_data) + len(doc2_data),
+            'similarity': analytics['similarity'],
+            'timings_ms': {stage: round(best[stage] * 1000, 3) for stage in BENCH_STAGES},
+            'total_ms': round(total * 1000, 3),
+            'words_per_second': round(words / total) if total else None,
+            'peak_memory_mb': round(peak / 1024 / 1024, 2)
+        })
+    
+    scaling = {}
+    if len(points) > 1 and points[0]['words'] and points[-1]['words'] > points[0]['words']:
+        first, last = points[0], points[-1]
+        for stage in BENCH_STAGES + ('total',):
+            start = first['total_ms'] if stage == 'total' else first['timings_ms'][stage]
+            end = last['total_ms'] if stage == 'total' else last['timings_ms'][stage]
+            if start > 0 and end > 0:
+                scaling[stage] = round(math.log(end / start) / math.log(last['words'] / first['words']), 2)
+    
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'sizes': list(sizes), 'edit_rate': edit_rate, 'clustering': clustering, 'rtl': rtl,
+                   'tables': tables, 'backend': backend, 'repeat': repeat, 'seed': seed},
+        'points': points,
+        'scaling': scaling
+    }
+
+def compare_benchmarks(report, baseline):
+    """Return per-size, per-stage time ratios of `report` against an earlier `baseline` report"""
+    baseline_points = {point['paragraphs']: point for point in baseline['points']}
+    ratios = []
+    for point in report['points']:
+        previous = baseline_points.get(point['paragraphs'])
+        if previous is None:
+            continue
+        stages = {stage: round(elapsed / previous['timings_ms'][stage], 3)
+                  for stage, elapsed in point['timings_ms'].items() if previous['timings_ms'].get(stage)}
+        stages['total'] = round(point['total_ms'] / previous['total_ms'], 3) if previous['total_ms'] else None
+        ratios.append({'paragraphs': point['paragraphs'], 'time_ratio': stages})
+    return ratios
+
+def run_bench_command(args):
+    """Run the `bench` command, printing the report and optionally saving it as JSON"""
+    report = benchmark_pipeline(args.sizes, args.edit_rate, args.clustering, args.rtl, args.tables,
+                                args.backend, args.repeat, args.seed)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as stream:
+            report['baseline'] = compare_benchmarks(report, json.load(stream))
+    
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as stream:
+            stream.write(output + '\n')
+    print(output)
+
+def run_generate_command(args):
+    """Run the `generate` command, writing a synthetic original/revised pair"""
+    doc1_data, doc2_data = generate_document_pair(args.paragraphs, args.edit_rate, args.clustering,
+                                                  args.rtl, args.tables, args.seed)
+    for path, data in ((args.doc1, doc1_data), (args.doc2, doc2_data)):
+        with open(path, 'wb') as stream:
+            stream.write(data)
+
+def load_corpus(directory, extractor=None):
+    """Load every .docx below `directory` as (relative path, digest, tokens), skipping Word lock files"""
+    documents = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith('.docx') and not filename.startswith('~$'):
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as stream:
+                    digest, _, tokens = load_document(stream, extractor=extractor)
+                documents.append((os.path.relpath(path, directory), digest, tokens))
+    return documents
+
+def run_corpus_command(args):
+    """Run the `corpus` command and print the pairing report as JSON"""
+    old_documents = load_corpus(args.old_dir, args.extractor)
+    new_documents = load_corpus(args.new_dir, args.extractor)
+    report = compare_corpus(old_documents, new_documents, args.backend, detail=args.detail, max_workers=args.workers)
+    print(json.dumps(dict(report, old_dir=args.old_dir, new_dir=args.new_dir, backend=args.backend),
+                     indent=2, ensure_ascii=False))
+
+PROFILE_DIR = os.environ.get('XSUKAX_PROFILE_DIR') or None
+PROFILE_THRESHOLD_MS = float(os.environ.get('XSUKAX_PROFILE_THRESHOLD_MS', 1000))
+PROFILE_SAMPLE_RATE = float(os.environ.get('XSUKAX_PROFILE_SAMPLE_RATE', 1.0))
+
+def _start_request_metrics():
+    """Start timing the current request and, when sampled, profiling it"""
+    _request_state.started = time.perf_counter()
+    _request_state.timings = {}
+    _request_state.profiler = None
+    
+    if PROFILE_DIR and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return
+        _request_state.profiler = profiler
+
+def _finish_request_metrics(response):
+    """Record the request in `metrics`, add Server-Timing and dump the profile of slow requests.
+
+    Streamed responses are recorded when they close, so the latency and the
+    profile cover generating the body; they get no Server-Timing header since
+    it is sent before the work is done.
+    """
+    from flask import request
+    started = getattr(_request_state, 'started', None)
+    if started is None:
+        return response
+    
+    timings = _request_state.timings
+    profiler = _request_state.profiler
+    _request_state.started = _request_state.timings = _request_state.profiler = None
+    
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    method = request.method
+    content_length = request.content_length
+    
+    def record():
+        elapsed = time.perf_counter() - started
+        metrics.inc('xsukax_requests_total', endpoint=endpoint, method=method, status=response.status_code)
+        metrics.observe('xsukax_request_duration_seconds', elapsed, endpoint=endpoint)
+        if content_length:
+            metrics.observe('xsukax_request_bytes', content_length, SIZE_BUCKETS, endpoint=endpoint)
+        if not response.is_streamed:
+            metrics.observe('xsukax_response_bytes', response.calculate_content_length() or 0, SIZE_BUCKETS,
+                            endpoint=endpoint)
+        
+        if profiler is not None:
+            profiler.disable()
+            if elapsed * 1000 >= PROFILE_THRESHOLD_MS:
+                name = f'{datetime.now():%Y%m%d-%H%M%S}-{endpoint.strip("/").replace("/", "_") or "index"}-{uuid.uuid4().hex[:8]}.prof'
+                try:
+                    os.makedirs(PROFILE_DIR, exist_ok=True)
+                    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+                    metrics.inc('xsukax_profiles_written_total')
+                except OSError:
+                    metrics.inc('xsukax_profile_errors_total')
+        return elapsed
+    
+    if response.is_streamed:
+        response.call_on_close(record)
+        return response
+    
+    elapsed = record()
+    entries = [f'{stage};dur={elapsed_ms:.2f}' for stage, elapsed_ms in timings.items()]
+    entries.append(f'total;dur={elapsed * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+def create_app():
+    """Build the Flask application; Flask is imported here so the CLI and library never load it"""
+    from flask import Flask
+    
+    class SpooledRequest(Flask.request_class):
+        def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+            return spooled_file()
+    
+    app = Flask(__name__)
+    app.request_class = SpooledRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.before_request(_start_request_metrics)
+    app.after_request(_finish_request_metrics)
+    return app
+
+def serve(host='0.0.0.0', port=5000, production=False, workers=None, threads=8):
+    """Run the web server.
+
+    By default this is Flask's debug server. With `production`, comparisons
+    run in a ComparisonPool of `workers` processes and requests are served by
+    waitress with `threads` threads, or by Werkzeug's threaded server when
+    waitress is not installed.
+    """
+    global comparison_pool
+    try:
+        import pythoncom
+        pythoncom.CoInitialize()
+    except:
+        pass
+    
+    app = create_app()
+    
+    print("=" * 60)
+    print("xsukax Word Document Comparator")
+    print("=" * 60)
+    print(f"Server running at: http://localhost:{port}")
+    if production:
+        comparison_pool = ComparisonPool(workers, MAX_CPU_SECONDS)
+        print(f"Production mode: {comparison_pool.workers} comparison workers, {threads} threads")
+    print("Press CTRL+C to stop the server")
+    print("=" * 60)
+    
+    if not production:
+        app.run(debug=True, host=host, port=port)
+        return
+    
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        waitress_serve = None
+        print("waitress is not installed; using Werkzeug's threaded server (pip install waitress)")
+    
+    try:
+        if waitress_serve is not None:
+            waitress_serve(app, host=host, port=port, threads=threads, max_request_body_size=MAX_UPLOAD_BYTES)
+        else:
+            app.run(host=host, port=port, threaded=True)
+    finally:
+        comparison_pool.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='xsukax Word Document Comparator')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    compare_parser = subparsers.add_parser('compare', help='compare two documents without starting the server')
+    compare_parser.add_argument('doc1', help='original .docx document')
+    compare_parser.add_argument('doc2', help='revised .docx document')
+    compare_parser.add_argument('--format', choices=('json', 'html', 'unified'), default='json')
+    compare_parser.add_argument('--output', '-o', help='write to this file instead of stdout')
+    compare_parser.add_argument('--backend', choices=sorted(DIFF_BACKENDS), default=DEFAULT_DIFF_BACKEND)
+    compare_parser.add_argument('--extractor', choices=EXTRACTORS, default=DEFAULT_EXTRACTOR)
+    compare_parser.add_argument('--formatting', action='store_true', help='also report formatting changes')
+    compare_parser.add_argument('--normalize', action='append', default=[],
+                                help=f'ignore differences of this kind when matching: {", ".join(NORMALIZATIONS)} '
+                                     '(repeat or comma-separate)')
+    compare_parser.add_argument('--context', type=int, default=3, help='context lines for unified output')
+    
+    batch_parser = subparsers.add_parser('batch', help='compare one base document against many revisions')
+    batch_parser.add_argument('base', help='base .docx document')
+    batch_parser.add_argument('candidates', nargs='+', help='revised .docx documents')
+    batch_parser.add_argument('--backend', choices=sorted(DIFF_BACKENDS), default=DEFAULT_DIFF_BACKEND)
+    batch_parser.add_argument('--detail', action='store_true', help='include changed line numbers')
+    batch_parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    batch_parser.add_argument('--extractor', choices=EXTRACTORS, default=DEFAULT_EXTRACTOR)
+    
+    corpus_parser = subparsers.add_parser('corpus', help='match and compare two folders of documents')
+    corpus_parser.add_argument('old_dir', help='folder of original .docx documents')
+    corpus_parser.add_argument('new_dir', help='folder of revised .docx documents')
+    corpus_parser.add_argument('--backend', choices=sorted(DIFF_BACKENDS), default=DEFAULT_DIFF_BACKEND)
+    corpus_parser.add_argument('--detail', action='store_true', help='include changed line numbers')
+    corpus_parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    corpus_parser.add_argument('--extractor', choices=EXTRACTORS, default=DEFAULT_EXTRACTOR)
+    
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic original/revised document pair')
+    generate_parser.add_argument('doc1', help='path of the original .docx to write')
+    generate_parser.add_argument('doc2', help='path of the revised .docx to write')
+    generate_parser.add_argument('--paragraphs', type=int, default=200)
+    
+    pipeline_parser = subparsers.add_parser('bench', help='time each pipeline stage on synthetic documents')
+    pipeline_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000],
+                                 help='document sizes in paragraphs')
+    pipeline_parser.add_argument('--backend', choices=sorted(DIFF_BACKENDS), default=DEFAULT_DIFF_BACKEND)
+    pipeline_parser.add_argument('--repeat', type=int, default=3, help='runs per size (best is reported)')
+    pipeline_parser.add_argument('--output', '-o', help='also save the JSON report to this file')
+    pipeline_parser.add_argument('--baseline', help='earlier JSON report to compare timings against')
+    
+    for synthetic_parser in (generate_parser, pipeline_parser):
+        synthetic_parser.add_argument('--edit-rate', type=float, default=0.05, help='fraction of words edited')
+        synthetic_parser.add_argument('--clustering', type=float, default=0.0,
+                                      help='chance (0-1) that an edit lands next to the previous one')
+        synthetic_parser.add_argument('--rtl', action='store_true', help='generate Arabic text')
+        synthetic_parser.add_argument('--tables', type=int, default=0, help='number of tables to add')
+        synthetic_parser.add_argument('--seed', type=int, default=0)
+    
+    serve_parser = subparsers.add_parser('serve', help='run the web server (the default command)')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    serve_parser.add_argument('--production', action='store_true',
+                              help='run comparisons in a process pool behind a multi-threaded server')
+    serve_parser.add_argument('--workers', type=int, default=int(os.environ.get('XSUKAX_WORKERS', 0)) or None,
+                              help='comparison worker processes in production mode (default: CPU count)')
+    serve_parser.add_argument('--threads', type=int, default=int(os.environ.get('XSUKAX_THREADS', 8)),
+                              help='request threads in production mode')
+    
+    bench_parser = subparsers.add_parser('bench-extract', help='compare the speed of the text extractors')
+    bench_parser.add_argument('files', nargs='+', help='.docx documents to extract')
+    bench_parser.add_argument('--repeat', type=int, default=3, help='runs per extractor (best is reported)')
+    
+    args = parser.parse_args()
+    if args.command == 'compare':
+        try:
+            args.normalize = parse_normalization(args.normalize)
+        except ValueError as e:
+            parser.error(str(e))
+        raise SystemExit(run_compare_command(args))
+    elif args.command == 'batch':
+        run_batch_command(args)
+    elif args.command == 'corpus':
+        run_corpus_command(args)
+    elif args.command == 'generate':
+        run_generate_command(args)
+    elif args.command == 'bench':
+        run_bench_command(args)
+    elif args.command == 'bench-extract':
+        print(json.dumps(benchmark_extractors(args.files, args.repeat), indent=2))
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.production, args.workers, args.threads)
+    else:
+        serve()